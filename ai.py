@@ -1,6 +1,82 @@
 from config import *
-from random import shuffle
+import threading
+from random import Random, random
 from copy import deepcopy
+from time import monotonic
+
+import book
+import logger
+from bitboard import orient_move
+from evaluation import EvaluatedPosition
+from solver import Solver, SolverTimeout
+from transposition import EXACT, LOWER, UPPER, TranspositionTable
+
+# xored into Zobrist key of positions searched by minimize_beta, as a position
+# has different values when it is the minimizing side to move
+MIN_NODE_KEY = Random(0xC5).getrandbits(64)
+
+# how many nodes are searched between two checks of the clock
+TIME_CHECK_NODES = 64
+
+# move ordering: best move stored in transposition table, then killer moves of the ply,
+# then by history heuristic with central columns first among equally scored moves
+HASH_MOVE_SCORE = 1 << 30
+KILLER_SCORE = 1 << 20
+CENTER_SCORES = [COLS // 2 - abs(COLS // 2 - col) for col in range(COLS)]
+
+# solvers of threads, AI workers have one each
+_solvers = threading.local()
+
+logger = logger.get_logger(__name__)
+
+
+class SearchTimeout(Exception):
+    """Raised inside the search when the time budget of the move runs out
+    """
+
+
+class SearchContext:
+    """State shared by all nodes of one search
+    """
+
+    def __init__(self, table, deadline=None, ordering=True, noise=0):
+        self.table = table
+        self.deadline = deadline
+        self.nodes = 0
+
+        # evaluations are off by up to noise in either direction, so weaker levels make mistakes
+        self.noise = noise
+
+        # ordering=False searches columns left to right, used to measure what ordering saves
+        self.ordering = ordering
+        # two most recent moves that caused a cutoff at each ply
+        self.killers = [[None, None] for _ in range(ROWS * COLS + 1)]
+        # cutoffs caused by a column for each player, weighted by depth of the cutoff
+        self.history = [[0] * COLS for _ in range(3)]
+
+    def tick(self):
+        """Counts a node and aborts the search when the deadline has passed
+        """
+        self.nodes += 1
+        if self.deadline is not None and self.nodes % TIME_CHECK_NODES == 0 and monotonic() > self.deadline:
+            raise SearchTimeout()
+
+    def evaluate(self, position, player):
+        """Value of a position where the search stops
+        """
+        value = evaluate(position, player)
+        if self.noise:
+            value += self.noise * (2 * random() - 1)
+        return value
+
+    def cutoff(self, position, move, side, depth):
+        """Remembers move of side that refuted the node of position searched to depth
+        """
+        killers = self.killers[len(position.history)]
+        if killers[0] != move:
+            killers[1] = killers[0]
+            killers[0] = move
+        self.history[side][move] += depth * depth
 
 
 def is_column_valid(board, col):
@@ -58,14 +134,14 @@ def count_sequence(board, player, length):
         """
         count = 0
         col_index = col
-        for row_index in reversed(range(row)):
-            if col_index > ROWS:
+        for row_index in reversed(range(row + 1)):
+            if col_index >= COLS:
                 break
             elif board[row_index][col_index] == board[row][col]:
                 count += 1
             else:
                 break
-            col_index += 1  # increment column when row is incremented
+            col_index += 1  # increment column when row is decremented
         return int(count >= length)
 
     def pos_diagonal_seq(row, col):
@@ -74,7 +150,7 @@ def count_sequence(board, player, length):
         count = 0
         col_index = col
         for row_index in range(row, ROWS):
-            if col_index > ROWS:
+            if col_index >= COLS:
                 break
             elif board[row_index][col_index] == board[row][col]:
                 count += 1
@@ -126,10 +202,153 @@ def game_is_over(board):
     return count_sequence(board, HUMAN_PLAYER, 4) >= 1 or count_sequence(board, AI_PLAYER, 4) >= 1
 
 
-def minimax_alpha_beta(board, depth, player):
+def evaluate(position, player):
+    """Same as utility_value, but for a bitboard Position
+    """
+    opponent = AI_PLAYER if player == HUMAN_PLAYER else HUMAN_PLAYER
+
+    player_twos, player_threes, player_fours = position.sequence_counts(player)
+    opponent_twos, opponent_threes, opponent_fours = position.sequence_counts(opponent)
+
+    if opponent_fours > 0:
+        return float('-inf')
+
+    player_score = player_fours * 99999 + player_threes * 999 + player_twos * 99
+    opponent_score = opponent_threes * 999 + opponent_twos * 99
+    return player_score - opponent_score
+
+
+def position_is_over(position):
+    """Same as game_is_over, but for a bitboard Position
+    """
+    return position.is_won(HUMAN_PLAYER) or position.is_won(AI_PLAYER)
+
+
+def book_move(position, player):
+    """Move of the opening book for position, None if the book has no move or there is no book
+    """
+    # the book is built for AI answering a human who moves first
+    if player != AI_PLAYER:
+        return None
+
+    opening_book = book.get_book()
+    move = opening_book.lookup(position) if opening_book is not None else None
+    if move is not None:
+        logger.debug(f'Book move {move}.')
+    return move
+
+
+def get_solver():
+    """Solver of the current thread, kept so that it reuses bounds of the positions it has solved before
+    """
+    solver = getattr(_solvers, 'solver', None)
+    if solver is None:
+        solver = _solvers.solver = Solver()
+    return solver
+
+
+def solver_move(position, player):
+    """Move of perfect play for position, None if too many cells are empty to solve it quickly
+       or solving it takes more than AI_SOLVER_BUDGET seconds
+    """
+    if ROWS * COLS - position.count > AI_SOLVER_EMPTY_CELLS or position_is_over(position):
+        return None
+
+    solver = get_solver()
+    solver.restart(monotonic() + AI_SOLVER_BUDGET)
+    try:
+        move, outcome = solver.best_move(position, player)
+    except SolverTimeout:
+        logger.debug(f'Gave up solving after {solver.nodes} nodes.')
+        return None
+    logger.debug(f'Solved move {move}: {outcome} in {solver.nodes} nodes.')
+    return move
+
+
+def known_move(position, player, use_book=True, use_solver=True):
+    """Move taken from the opening book or the endgame solver without heuristic search, None if there is none
+    """
+    move = book_move(position, player) if use_book else None
+    if move is None and use_solver:
+        move = solver_move(position, player)
+    return move
+
+
+def minimax_alpha_beta(board, depth, player, table=None, use_book=True, use_solver=True, noise=0):
+    """Picks the best move for player on board searching to a fixed depth.
+       table is a TranspositionTable shared by all nodes of the search, a new one is used when not given
+    """
+    position = EvaluatedPosition.from_board(board)
+    move = known_move(position, player, use_book, use_solver)
+    if move is not None:
+        return move
+
+    if table is None:
+        table = TranspositionTable()
+    table.new_search()
+
     # get array of possible moves
-    valid_moves = get_valid_moves(board)
-    shuffle(valid_moves)
+    valid_moves = root_moves(position)
+
+    return search_root(position, valid_moves, depth, player, SearchContext(table, noise=noise))[0]
+
+
+def iterative_deepening(board, player, budget, table=None, max_depth=None, use_book=True, use_solver=True,
+                        noise=0):
+    """Picks the best move for player on board searching to depth 1, 2, 3... until budget seconds run out.
+       The move found by the deepest completed search is returned, so the result never waits for more
+       than a single node after the deadline.
+    """
+    start = monotonic()
+    position = EvaluatedPosition.from_board(board)
+    move = known_move(position, player, use_book, use_solver)
+    if move is not None:
+        return move
+
+    if table is None:
+        table = TranspositionTable()
+    table.new_search()
+
+    opponent = HUMAN_PLAYER if player == AI_PLAYER else AI_PLAYER
+
+    valid_moves = root_moves(position)
+    best_move = valid_moves[0]
+
+    empty_cells = ROWS * COLS - position.count
+    max_depth = empty_cells if max_depth is None else min(max_depth, empty_cells)
+
+    # killer moves and history are kept between iterations
+    context = SearchContext(table, noise=noise)
+
+    depth = 0
+    for depth in range(1, max_depth + 1):
+        # depth 1 always completes so there is a move to answer with
+        context.deadline = start + budget if depth > 1 else None
+        try:
+            best_move = search_root(position, valid_moves, depth, player, context)[0]
+        except SearchTimeout:
+            depth -= 1
+            break
+        # next iteration starts with the principal variation of this one, the rest of it
+        # is found in the table as best moves of the stored positions
+        valid_moves.remove(best_move)
+        valid_moves.insert(0, best_move)
+
+    logger.debug(f'Searched to depth {depth} in {monotonic() - start:.3f}s, '
+                 f'principal variation {principal_variation(position, best_move, player, opponent, table, depth)}.')
+    return best_move
+
+
+def root_moves(position):
+    """Legal moves of position, central columns first and equally central ones in random order
+    """
+    return sorted(position.legal_moves(), key=lambda col: (CENTER_SCORES[col], random()), reverse=True)
+
+
+def search_root(position, valid_moves, depth, player, context):
+    """Searches every move of valid_moves in given order, returns the first of the best ones and its score.
+       Scores of the other moves only have to be known not to be better, so alpha is raised on the way.
+    """
     best_move = valid_moves[0]
     best_score = float("-inf")
 
@@ -141,64 +360,203 @@ def minimax_alpha_beta(board, depth, player):
 
     # go through all of those boards
     for move in valid_moves:
-        # create new board from move
-        temp_board = make_move(board, move, player)[0]
-        # call min on that new board
-        board_score = minimize_beta(temp_board, depth - 1, alpha, beta, player, opponent)
+        # make the move in place and take it back after the subtree is searched
+        position.play(move, player)
+        try:
+            # call min on that new board
+            board_score = minimize_beta(position, depth - 1, alpha, beta, player, opponent, context)
+        finally:
+            position.undo()
         if board_score > best_score:
-            best_score = board_score
+            best_score = alpha = board_score
             best_move = move
-    return best_move
+    return best_move, best_score
+
+
+def search_moves(board, valid_moves, depth, player, noise=0, deadline=None):
+    """Searches only valid_moves of board to depth 1, 2... up to depth until monotonic() passes deadline,
+       one part of a root-parallel search. Returns the first of the best moves of the part and its score
+       for every completed depth, depth 1 always completes
+    """
+    position = EvaluatedPosition.from_board(board)
+    context = SearchContext(TranspositionTable(), noise=noise)
+    results = []
+    for current in range(1, depth + 1):
+        # root moves keep their order, so the merged result is the one of a serial search of the same depth
+        context.deadline = deadline if current > 1 else None
+        try:
+            results.append(search_root(position, valid_moves, current, player, context))
+        except SearchTimeout:
+            break
+    return results
+
+
+def split_root_moves(valid_moves, parts):
+    """Deals ordered root moves round-robin to at most parts non-empty parts, keeping their order
+    """
+    return [valid_moves[i::parts] for i in range(min(parts, len(valid_moves)))]
+
+
+def merge_root_results(valid_moves, results):
+    """Picks the best of (move, score) results of the parts. On equal scores the move met first in
+       valid_moves wins, so the result is the move search_root would pick searching all of them
+    """
+    return max(results, key=lambda result: (result[1], -valid_moves.index(result[0])))
+
+
+def merge_part_results(valid_moves, part_results):
+    """Merges results of search_moves of all parts at the deepest depth every part has completed.
+       Returns the move, its score and the depth
+    """
+    depth = min(len(results) for results in part_results)
+    move, score = merge_root_results(valid_moves, [results[depth - 1] for results in part_results])
+    return move, score, depth
+
+
+def parallel_minimax(board, depth, player, executor, parts, use_book=True, use_solver=True, noise=0):
+    """Same as minimax_alpha_beta without a shared table, with root moves searched by parts processes of executor
+    """
+    position = EvaluatedPosition.from_board(board)
+    move = known_move(position, player, use_book, use_solver)
+    if move is not None:
+        return move
+
+    valid_moves = root_moves(position)
+    futures = [executor.submit(search_moves, board, part, depth, player, noise)
+               for part in split_root_moves(valid_moves, parts)]
+    return merge_part_results(valid_moves, [future.result() for future in futures])[0]
+
+
+def principal_variation(position, move, player, opponent, table, length):
+    """Expected continuation starting with move: up to length best moves stored in the table, alternating sides
+    """
+    variation = []
+    sides = [player, opponent]
+
+    while move is not None and position.can_play(move) and len(variation) < length:
+        position.play(move, sides[len(variation) % 2])
+        variation.append(move)
+        key, mirrored = node_key(position, len(variation) % 2 == 1)
+        entry = table.probe(key)
+        move = orient_move(entry.move, mirrored) if entry is not None else None
+
+    for _ in variation:
+        position.undo()
+    return variation
+
+
+def node_key(position, minimizing):
+    """Transposition table key of the node, the same for a position and its mirror image.
+       Returns the key and whether moves have to be mirrored between the table and the position
+    """
+    key, mirrored = position.canonical_key()
+    return (key ^ MIN_NODE_KEY if minimizing else key), mirrored
+
+
+def cuts_off(entry, depth, a, b):
+    """Says whether stored entry decides the search of the node with (a, b) window
+    """
+    if entry is None or entry.depth < depth:
+        return False
+
+    return entry.bound == EXACT or \
+        entry.bound == LOWER and entry.value >= b or \
+        entry.bound == UPPER and entry.value <= a
+
+
+def bound_of(value, a, b):
+    """Kind of value returned by a search with (a, b) window
+    """
+    if value <= a:
+        return UPPER
+    if value >= b:
+        return LOWER
+    return EXACT
 
 
-def minimize_beta(board, depth, a, b, player, opponent):
-    valid_moves = []
-    for col in range(7):
-        # if column col is a legal move...
-        if is_column_valid(board, col):
-            # make the move in column col for curr_player
-            temp = make_move(board, col, player)[2]
-            valid_moves.append(temp)
+def ordered_moves(position, hash_move, side, context):
+    """Legal moves of position for side in order they are worth searching,
+       moves scored equally are in random order
+    """
+    moves = position.legal_moves()
+    if not context.ordering:
+        return moves
+
+    killers = context.killers[len(position.history)]
+    history = context.history[side]
+
+    def score(col):
+        if col == hash_move:
+            return HASH_MOVE_SCORE
+        if col in killers:
+            return KILLER_SCORE - killers.index(col)
+        return history[col] * COLS + CENTER_SCORES[col]
+
+    return sorted(moves, key=lambda col: (score(col), random()), reverse=True)
 
+
+def minimize_beta(position, depth, a, b, player, opponent, context):
+    context.tick()
     # check to see if game over
-    if depth == 0 or len(valid_moves) == 0 or game_is_over(board):
-        return utility_value(board, player)
+    if depth == 0 or position.is_full() or position_is_over(position):
+        return context.evaluate(position, player)
+
+    key, mirrored = node_key(position, True)
+    entry = context.table.probe(key)
+    if cuts_off(entry, depth, a, b):
+        return entry.value
+    hash_move = orient_move(entry.move, mirrored) if entry is not None else None
 
-    valid_moves = get_valid_moves(board)
     beta = b
+    best_move = None
 
-    # if end of tree evaluate scores
-    for move in valid_moves:
-        board_score = float("inf")
-        # else continue down tree as long as ab conditions met
-        if a < beta:
-            temp_board = make_move(board, move, opponent)[0]
-            board_score = maximize_alpha(temp_board, depth - 1, a, beta, player, opponent)
+    for move in ordered_moves(position, hash_move, opponent, context):
+        position.play(move, opponent)
+        try:
+            board_score = maximize_alpha(position, depth - 1, a, beta, player, opponent, context)
+        finally:
+            position.undo()
 
-        beta = min(beta, board_score)
+        if board_score < beta:
+            beta = board_score
+            best_move = move
+        # continue down tree as long as ab conditions met
+        if a >= beta:
+            context.cutoff(position, move, opponent, depth)
+            break
 
+    context.table.store(key, depth, bound_of(beta, a, b), beta, orient_move(best_move, mirrored))
     return beta
 
 
-def maximize_alpha(board, depth, a, b, player, opponent):
-    valid_moves = []
-    for col in range(7):
-        # if column col is a legal move...
-        if is_column_valid(board, col):
-            # make the move in column col for curr_player
-            temp = make_move(board, col, player)[2]
-            valid_moves.append(temp)
+def maximize_alpha(position, depth, a, b, player, opponent, context):
+    context.tick()
     # check to see if game over
-    if depth == 0 or len(valid_moves) == 0 or game_is_over(board):
-        return utility_value(board, player)
+    if depth == 0 or position.is_full() or position_is_over(position):
+        return context.evaluate(position, player)
+
+    key, mirrored = node_key(position, False)
+    entry = context.table.probe(key)
+    if cuts_off(entry, depth, a, b):
+        return entry.value
+    hash_move = orient_move(entry.move, mirrored) if entry is not None else None
 
     alpha = a
-    # if end of tree, evaluate scores
-    for move in valid_moves:
-        board_score = float("-inf")
-        if alpha < b:
-            temp_board = make_move(board, move, player)[0]
-            board_score = minimize_beta(temp_board, depth - 1, alpha, b, player, opponent)
+    best_move = None
+
+    for move in ordered_moves(position, hash_move, player, context):
+        position.play(move, player)
+        try:
+            board_score = minimize_beta(position, depth - 1, alpha, b, player, opponent, context)
+        finally:
+            position.undo()
+
+        if board_score > alpha:
+            alpha = board_score
+            best_move = move
+        if alpha >= b:
+            context.cutoff(position, move, player, depth)
+            break
 
-        alpha = max(alpha, board_score)
+    context.table.store(key, depth, bound_of(alpha, a, b), alpha, orient_move(best_move, mirrored))
     return alpha
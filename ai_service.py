@@ -0,0 +1,233 @@
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from time import monotonic
+from typing import Callable, List, Optional, Tuple
+
+import ai
+import codec
+import config
+import logger
+import transposition
+from bitboard import Position
+
+# introducing a logger
+logger = logger.get_logger(__name__)
+
+
+def get_level(level: Optional[str]) -> dict:
+    """
+    :param level: key of config.AI_LEVELS
+    :return: search profile of the level, the one of config.AI_DEFAULT_LEVEL for unknown levels
+    """
+    return config.AI_LEVELS.get(level, config.AI_LEVELS[config.AI_DEFAULT_LEVEL])
+
+
+def compute_move(field: bytes, player: int, level: str, game_id: Optional[int] = None) -> int:
+    """
+    Runs in a worker process: picks AI move for a serialized board
+    :param field: matrix encoded by codec.encode_field
+    :param player: player to find the move for
+    :param level: key of config.AI_LEVELS to play at
+    :param game_id: id of the game, its transposition table is kept in the worker when AI_TT_KEEP is set
+    :return: column to drop the stone to
+    """
+    profile = get_level(level)
+    board = codec.decode_field(field)
+    if config.AI_TT_KEEP and game_id is not None:
+        # the human moves first, so the first AI move sees at most one stone
+        first_move = sum(cell != 0 for row in board for cell in row) <= 1
+        table = transposition.get_game_table(game_id, level, first_move)
+    else:
+        table = transposition.TranspositionTable()
+
+    col = ai.iterative_deepening(
+        board, player, profile['budget'], table,
+        max_depth=profile['depth'],
+        use_book=profile['book'],
+        use_solver=profile['solver'],
+        noise=profile['noise']
+    )
+    logger.info(f'AI moved to column {col} in game {game_id} at level {level}, transposition table: {table.stats()}')
+    return col
+
+
+def probe_root(field: bytes, player: int, use_book: bool, use_solver: bool) -> Tuple[Optional[int], List[int]]:
+    """
+    Runs in a worker process: looks the move of a root-parallel search up in the book and the solver
+    :param field: matrix encoded by codec.encode_field
+    :param player: player to find the move for
+    :return: book or solver move (or None) & root moves to split between parts when there is none
+    """
+    position = Position.from_board(codec.decode_field(field))
+    move = ai.known_move(position, player, use_book, use_solver)
+    return move, ai.root_moves(position) if move is None else []
+
+
+def search_root_moves(field: bytes, player: int, moves: List[int], depth: int, noise: float = 0,
+                      deadline: Optional[float] = None) -> List[Tuple[int, float]]:
+    """
+    Runs in a worker process: searches a part of root moves of a root-parallel search
+    :param field: matrix encoded by codec.encode_field
+    :param player: player to find the move for
+    :param moves: root moves to search, in order
+    :param depth: max depth of the search
+    :param noise: max error added to evaluations
+    :param deadline: monotonic() time deeper searches are given up at, the clock is shared by processes
+    :return: best of the moves and its score for every completed depth
+    """
+    return ai.search_moves(codec.decode_field(field), moves, depth, player, noise, deadline)
+
+
+class AIService:
+    """
+    Computes AI moves in a pool of processes so bot handler threads never wait for the search.
+    At most `queue_size` jobs are computed or waiting at once, further moves are refused. A move takes
+    one job, or `parallel` of them with root-parallel search.
+    """
+
+    def __init__(self, workers: int = config.AI_WORKERS, queue_size: int = config.AI_QUEUE_SIZE):
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.executor_lock = threading.Lock()
+        # callbacks talk to Telegram and DB, so they don't block the thread collecting results
+        self.callbacks = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ai-callback')
+        self.queue_size = queue_size
+        self.queued = 0
+        self.queued_lock = threading.Lock()
+
+    def submit(self, field: bytes, player: int, level: str, game_id: Optional[int],
+               callback: Callable[[Future], None]) -> bool:
+        """
+        Queues AI move computation
+        :param field: matrix encoded by codec.encode_field
+        :param player: player to find the move for
+        :param level: key of config.AI_LEVELS, its profile decides how the move is searched
+        :param game_id: id of the game the move is for
+        :param callback: called with the finished future in a callback thread
+        :return: False if the queue is full and the move was not queued
+        """
+        profile = get_level(level)
+        jobs = max(1, profile['parallel'])
+        if not self._take(jobs):
+            logger.warning(f'AI queue is full, refusing move for game {game_id}.')
+            return False
+
+        def done(future: Future) -> None:
+            self._give(jobs)
+            self.callbacks.submit(self._run_callback, callback, future)
+
+        try:
+            executor = self.executor
+            try:
+                future = self._submit(executor, field, player, level, game_id, profile)
+            except BrokenProcessPool:
+                # a worker process died, the pool refuses every call from then on
+                logger.exception(f'AI worker pool is broken, restarting it for game {game_id}.')
+                executor = self._restart(executor)
+                future = self._submit(executor, field, player, level, game_id, profile)
+        except Exception:
+            self._give(jobs)
+            raise
+        future.add_done_callback(done)
+        return True
+
+    def _take(self, jobs: int) -> bool:
+        with self.queued_lock:
+            if self.queued + jobs > self.queue_size:
+                return False
+            self.queued += jobs
+            return True
+
+    def _give(self, jobs: int) -> None:
+        with self.queued_lock:
+            self.queued -= jobs
+
+    def _submit(self, executor: ProcessPoolExecutor, field: bytes, player: int, level: str,
+                game_id: Optional[int], profile: dict) -> Future:
+        if profile['parallel'] > 1:
+            return self._submit_parallel(executor, field, player, profile)
+        return executor.submit(compute_move, field, player, level, game_id)
+
+    def _restart(self, broken: ProcessPoolExecutor) -> ProcessPoolExecutor:
+        """
+        Replaces the broken pool of processes, unless another thread has replaced it already
+        :return: the working pool
+        """
+        with self.executor_lock:
+            if self.executor is broken:
+                broken.shutdown(wait=False)
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self.executor
+
+    def _submit_parallel(self, executor: ProcessPoolExecutor, field: bytes, player: int, profile: dict) -> Future:
+        """
+        Looks the move up in the book and the solver in a worker, then splits root moves between processes
+        of the profile searching until its budget runs out. The returned future gets the book or solver
+        move, or the merged result of the deepest search every part has completed
+        """
+        depth = profile['depth'] or config.AI_PARALLEL_DEPTH
+        deadline = monotonic() + profile['budget']
+        result = Future()
+
+        def probe_done(probe: Future) -> None:
+            try:
+                move, moves = probe.result()
+                if move is not None:
+                    result.set_result(move)
+                    return
+                futures = [executor.submit(search_root_moves, field, player, part, depth, profile['noise'], deadline)
+                           for part in ai.split_root_moves(moves, profile['parallel'])]
+            except Exception as e:
+                result.set_exception(e)
+                return
+
+            lock = threading.Lock()
+            pending = [len(futures)]
+
+            def part_done(_: Future) -> None:
+                with lock:
+                    pending[0] -= 1
+                    if pending[0]:
+                        return
+                try:
+                    move, _, searched = ai.merge_part_results(moves, [future.result() for future in futures])
+                except Exception as e:
+                    result.set_exception(e)
+                else:
+                    logger.info(f'Root-parallel search of depth {searched} in {len(futures)} parts '
+                                f'moved to column {move}.')
+                    result.set_result(move)
+
+            for future in futures:
+                future.add_done_callback(part_done)
+
+        executor.submit(probe_root, field, player, profile['book'], profile['solver']).add_done_callback(probe_done)
+        return result
+
+    @staticmethod
+    def _run_callback(callback: Callable[[Future], None], future: Future) -> None:
+        try:
+            callback(future)
+        except Exception:
+            logger.exception('AI move callback failed.')
+
+    def shutdown(self) -> None:
+        self.executor.shutdown()
+        self.callbacks.shutdown()
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_service() -> AIService:
+    """
+    :return: AI service of the bot, created with the first request so worker processes are
+    not started by merely importing the module
+    """
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = AIService()
+        return _service
@@ -0,0 +1,172 @@
+"""
+Asyncio mode of the bot: updates are polled in an event loop and handed to worker threads running the
+handlers of bot.py, updates of different games at once and those of a game one by one, as the sharded
+dispatcher of the other modes does. The game logic of utils stays synchronous and shared with the other
+modes, only the batches of independent Telegram calls it makes with utils.concurrently() are awaited
+together in the loop, within the flood limits of outbound.
+"""
+import asyncio
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Set
+
+import telebot
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+import config
+import logger
+import outbound
+import utils
+from dispatcher import update_key
+
+# introducing a logger
+logger = logger.get_logger(__name__)
+
+
+class AsyncRuntime:
+    """
+    Event loop polling updates for the handlers of bot and making their concurrent Telegram calls
+    """
+
+    def __init__(self, bot: telebot.TeleBot, workers: int = config.ASYNC_WORKERS,
+                 queue_size: int = config.ASYNC_QUEUE_SIZE, limiter: Optional[outbound.RateLimiter] = None):
+        # workers run the handlers, so the bot must not queue them to its own threads again
+        bot.threaded = False
+        self.bot = bot
+        # connections aiohttp keeps for the calls made in the loop
+        asyncio_helper.REQUEST_LIMIT = config.HTTP_POOL_SIZE
+        self.async_bot = AsyncTeleBot(bot.token)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='async-worker')
+        self.queue_size = queue_size
+        # flood limits of the calls made in the loop, the other calls are limited by outbound.install()
+        self.limiter = limiter
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.poller: Optional[asyncio.Task] = None
+        self.tasks: Set[asyncio.Task] = set()
+        # last update of every game or chat being handled, the next update of it waits for it
+        self.tails: Dict[Hashable, asyncio.Task] = {}
+        self.signatures: Dict[str, inspect.Signature] = {}
+
+    def run(self) -> None:
+        """
+        Polls and handles updates until interrupted or stopped
+        """
+        asyncio.run(self._main())
+
+    def stop(self) -> None:
+        """
+        Stops polling, updates already received are handled before run() returns. Called from other threads
+        """
+        if self.loop and self.poller:
+            self.loop.call_soon_threadsafe(self.poller.cancel)
+
+    async def _main(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.queue_size)
+        utils.set_call_runner(self.run_calls)
+        self.poller = asyncio.create_task(self._poll(slots))
+        try:
+            await self.poller
+        except asyncio.CancelledError:
+            pass
+        finally:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            utils.set_call_runner(None)
+            self.executor.shutdown()
+            await self.async_bot.close_session()
+
+    async def _poll(self, slots: asyncio.Semaphore) -> None:
+        offset = None
+        while True:
+            try:
+                updates = await self.async_bot.get_updates(
+                    offset=offset,
+                    timeout=config.ASYNC_POLL_TIMEOUT,
+                    allowed_updates=['message', 'callback_query']
+                )
+            except Exception:
+                logger.exception('Getting updates failed.')
+                await asyncio.sleep(1)
+                continue
+
+            for update in updates:
+                offset = update.update_id + 1
+                # waits while queue_size updates are being handled
+                await slots.acquire()
+                self._dispatch(update, slots)
+
+    def _dispatch(self, update: telebot.types.Update, slots: asyncio.Semaphore) -> None:
+        # a cached lookup mostly, blocking the loop for it keeps updates of a game in order
+        key = update_key(update)
+        task = asyncio.create_task(self._handle(update, self.tails.get(key), slots))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        if key is not None:
+            self.tails[key] = task
+            task.add_done_callback(partial(self._forget, key))
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self.tails.get(key) is task:
+            del self.tails[key]
+
+    async def _handle(self, update: telebot.types.Update, previous: Optional[asyncio.Task],
+                      slots: asyncio.Semaphore) -> None:
+        try:
+            if previous:
+                # failures of the previous update are logged by its own task
+                await asyncio.wait([previous])
+            await self.loop.run_in_executor(self.executor, self.bot.process_new_updates, [update])
+        except Exception:
+            logger.exception(f'Handling update {update.update_id} failed.')
+        finally:
+            slots.release()
+
+    def run_calls(self, calls: Sequence[partial]) -> List[Any]:
+        """
+        Makes calls of utils.concurrently() in the loop and waits for them, called from threads other than
+        the loop's one: workers, AI service callbacks and the matchmaking sweeper
+        """
+        return asyncio.run_coroutine_threadsafe(self._gather(calls), self.loop).result()
+
+    async def _gather(self, calls: Sequence[partial]) -> List[Any]:
+        # calls to a chat are chained in their order, chains of different chats run at once
+        chains: Dict[Hashable, List[int]] = {}
+        chat_ids = [self._arguments(call).get('chat_id') for call in calls]
+        for i, chat_id in enumerate(chat_ids):
+            chains.setdefault(('chat', chat_id) if chat_id is not None else ('call', i), []).append(i)
+
+        results: List[Any] = [None] * len(calls)
+
+        async def chain(indexes: List[int]) -> None:
+            for i in indexes:
+                results[i] = await self._call(calls[i], chat_ids[i])
+
+        await asyncio.gather(*(chain(indexes) for indexes in chains.values()))
+        return results
+
+    async def _call(self, call: partial, chat_id: Optional[Any]) -> Any:
+        method = getattr(self.async_bot, call.func.__name__)
+        if not self.limiter:
+            return await method(*call.args, **call.keywords)
+
+        for attempt in range(config.OUTBOUND_MAX_RETRIES + 1):
+            await asyncio.sleep(self.limiter.reserve(chat_id))
+            try:
+                return await method(*call.args, **call.keywords)
+            except asyncio_helper.ApiTelegramException as e:
+                seconds = outbound.retry_after(e.result_json)
+                if seconds is None or attempt == config.OUTBOUND_MAX_RETRIES:
+                    raise
+                logger.warning(f'{call.func.__name__} to chat {chat_id} hit the flood limit, retrying in {seconds}s.')
+                self.limiter.pause(chat_id, seconds)
+
+    def _arguments(self, call: partial) -> Dict[str, Any]:
+        """
+        :return: arguments of a partial of a bot method by their names
+        """
+        name = call.func.__name__
+        if name not in self.signatures:
+            self.signatures[name] = inspect.signature(getattr(self.async_bot, name))
+        return self.signatures[name].bind(*call.args, **call.keywords).arguments
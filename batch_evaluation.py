@@ -0,0 +1,149 @@
+"""
+Evaluates many boards at once with numpy, for analytics, replays and self-play.
+Boards are (N, ROWS, COLS) int8 arrays of game field values. Results for every board are
+the same as utils.has_winner and ai.utility_value give for it.
+Compare both on random boards from the repository root: python -m benchmarks.batch_evaluation
+"""
+from typing import NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+from config import AI_PLAYER, COLS, HUMAN_PLAYER, ROWS
+
+# status of a board
+NONE = 0
+WIN = 1
+DRAW = 2
+
+# (row delta, col delta) in the order utils.has_winner tries them from every cell
+WIN_DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1))
+# lines ai.count_sequence counts: down, right, down-right, up-right
+SEQUENCE_DIRECTIONS = ((1, 0), (0, 1), (1, 1), (-1, 1))
+# weights of lines of every length in ai.utility_value
+SEQUENCE_WEIGHTS = {2: 99, 3: 999, 4: 99999}
+
+
+def line_windows(length: int, directions: Sequence[Tuple[int, int]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    :param length: number of cells in a line
+    :param directions: (row delta, col delta) of lines
+    :return: flat indices of cells of every line fitting on the board (W, length), first cell (W, 2)
+    and direction (W, 2) of every line; ordered by first cell row by row, then by direction
+    """
+    cells, starts, steps = [], [], []
+    for row in range(ROWS):
+        for col in range(COLS):
+            for dr, dc in directions:
+                end_row = row + dr * (length - 1)
+                end_col = col + dc * (length - 1)
+                if 0 <= end_row < ROWS and 0 <= end_col < COLS:
+                    cells.append([(row + dr * i) * COLS + col + dc * i for i in range(length)])
+                    starts.append((row, col))
+                    steps.append((dr, dc))
+    return np.array(cells, dtype=np.intp), np.array(starts, dtype=np.int8), np.array(steps, dtype=np.int8)
+
+
+def window_masks(cells: np.ndarray) -> np.ndarray:
+    """
+    :param cells: flat indices of cells of every line (W, length)
+    :return: (ROWS * COLS, W) matrix with ones where a cell belongs to a line, so multiplying
+    a row of stones by it counts stones in every line
+    """
+    masks = np.zeros((ROWS * COLS, len(cells)), dtype=np.float32)
+    masks[cells, np.arange(len(cells))[:, None]] = 1
+    return masks
+
+
+WIN_CELLS, WIN_STARTS, WIN_STEPS = line_windows(4, WIN_DIRECTIONS)
+SEQUENCE_MASKS = {length: window_masks(line_windows(length, SEQUENCE_DIRECTIONS)[0]) for length in SEQUENCE_WEIGHTS}
+
+
+class Winners(NamedTuple):
+    status: np.ndarray  # (N,) NONE, WIN or DRAW
+    winner: np.ndarray  # (N,) value of cells of the winning line, 0 unless status is WIN
+    coords: np.ndarray  # (N, 2) first cell of the winning line, (0, 0) unless status is WIN
+    directions: np.ndarray  # (N, 2) direction of the winning line, (0, 0) unless status is WIN
+
+
+class Evaluation(NamedTuple):
+    winners: Winners
+    scores: np.ndarray  # (N,) ai.utility_value of every board
+
+
+def as_boards(boards) -> np.ndarray:
+    """
+    :param boards: array-like of N game fields
+    :return: boards as a (N, ROWS * COLS) int8 array
+    """
+    boards = np.asarray(boards, dtype=np.int8)
+    if boards.ndim != 3 or boards.shape[1:] != (ROWS, COLS):
+        raise ValueError(f'Expected boards of shape (N, {ROWS}, {COLS}), got {boards.shape}')
+    return boards.reshape(len(boards), ROWS * COLS)
+
+
+def find_winners(boards) -> Winners:
+    """
+    Batched utils.has_winner: the line it would report is the first one in row by row order of
+    first cells, so the bomb line painted from the results is the same
+    :param boards: array-like of N game fields
+    :return: status of every board & its winning line
+    """
+    boards = as_boards(boards)
+
+    values = boards[:, WIN_CELLS]
+    lines = (values[:, :, 0] != 0) & (values == values[:, :, :1]).all(axis=2)
+    won = lines.any(axis=1)
+    first = lines.argmax(axis=1)
+
+    status = np.full(len(boards), NONE, dtype=np.int8)
+    status[~won & (boards != 0).all(axis=1)] = DRAW
+    status[won] = WIN
+
+    winner = np.where(won, values[np.arange(len(boards)), first, 0], 0).astype(np.int8)
+    coords = np.where(won[:, None], WIN_STARTS[first], 0).astype(np.int8)
+    directions = np.where(won[:, None], WIN_STEPS[first], 0).astype(np.int8)
+    return Winners(status, winner, coords, directions)
+
+
+def sequence_counts(boards, player: int, length: int) -> np.ndarray:
+    """
+    Batched ai.count_sequence
+    :param boards: array-like of N game fields
+    :param player: value of cells of player
+    :param length: length of lines, 2, 3 or 4
+    :return: (N,) number of lines of length cells filled by player on every board
+    """
+    return _sequence_counts(as_boards(boards), player, length)
+
+
+def _sequence_counts(boards: np.ndarray, player: int, length: int) -> np.ndarray:
+    stones = (boards == player).astype(np.float32)
+    return ((stones @ SEQUENCE_MASKS[length]) == length).sum(axis=1)
+
+
+def utility_values(boards, player: int = AI_PLAYER) -> np.ndarray:
+    """
+    Batched ai.utility_value
+    :param boards: array-like of N game fields
+    :param player: player whose score is counted as positive
+    :return: (N,) float scores, -inf where the opponent has a four
+    """
+    boards = as_boards(boards)
+    opponent = AI_PLAYER if player == HUMAN_PLAYER else HUMAN_PLAYER
+
+    scores = np.zeros(len(boards), dtype=np.float64)
+    for length, weight in SEQUENCE_WEIGHTS.items():
+        scores += weight * _sequence_counts(boards, player, length)
+        scores -= weight * _sequence_counts(boards, opponent, length)
+
+    scores[_sequence_counts(boards, opponent, 4) > 0] = float('-inf')
+    return scores
+
+
+def evaluate_boards(boards, player: int = AI_PLAYER) -> Evaluation:
+    """
+    :param boards: array-like of N game fields
+    :param player: player whose score is counted as positive
+    :return: status, winning lines and heuristic scores of all boards
+    """
+    return Evaluation(find_winners(boards), utility_values(boards, player))
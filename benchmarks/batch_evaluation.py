@@ -0,0 +1,89 @@
+"""
+Checks that batch_evaluation agrees with utils.has_winner and ai.utility_value on random boards
+and compares their speed.
+Run from the repository root: python -m benchmarks.batch_evaluation
+"""
+import argparse
+import random
+from time import monotonic
+
+import numpy as np
+
+import ai
+import batch_evaluation
+import utils
+from config import AI_PLAYER, COLS, HUMAN_PLAYER, ROWS
+
+
+def random_boards(count: int, seed: int) -> np.ndarray:
+    """
+    :return: (count, ROWS, COLS) boards filled by a random number of random moves, human moving first;
+    moves go on after a four, so some boards have several lines
+    """
+    rng = random.Random(seed)
+    boards = np.zeros((count, ROWS, COLS), dtype=np.int8)
+    for board in boards:
+        heights = [ROWS] * COLS
+        for ply in range(rng.randint(0, ROWS * COLS)):
+            col = rng.choice([col for col in range(COLS) if heights[col]])
+            heights[col] -= 1
+            board[heights[col], col] = HUMAN_PLAYER if ply % 2 == 0 else AI_PLAYER
+    return boards
+
+
+def scalar_results(boards: np.ndarray, player: int):
+    """
+    :return: has_winner result and utility value of every board
+    """
+    results = []
+    for board in boards:
+        field = board.tolist()
+        results.append((utils.has_winner(field), ai.utility_value(field, player)))
+    return results
+
+
+def mismatches(boards: np.ndarray, player: int, scalar, batch) -> int:
+    """
+    :return: number of boards batch results differ from scalar ones for
+    """
+    winners, scores = batch
+    count = 0
+    for i, ((winner, coords, direction), score) in enumerate(scalar):
+        if winner and direction == (0, 0):
+            expected = (batch_evaluation.DRAW, 0, (0, 0), (0, 0))
+        elif winner:
+            expected = (batch_evaluation.WIN, boards[i][coords], coords, direction)
+        else:
+            expected = (batch_evaluation.NONE, 0, (0, 0), (0, 0))
+
+        got = (winners.status[i], winners.winner[i], tuple(winners.coords[i]), tuple(winners.directions[i]))
+        if got != expected or scores[i] != score:
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--boards', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    boards = random_boards(args.boards, args.seed)
+
+    for player in (HUMAN_PLAYER, AI_PLAYER):
+        start = monotonic()
+        scalar = scalar_results(boards, player)
+        scalar_time = monotonic() - start
+
+        start = monotonic()
+        batch = batch_evaluation.evaluate_boards(boards, player)
+        batch_time = monotonic() - start
+
+        print(f'player {player}, {len(boards)} boards')
+        print(f'scalar:     {scalar_time:8.3f}s')
+        print(f'batch:      {batch_time:8.3f}s ({scalar_time / batch_time:.0f}x)')
+        print(f'mismatches: {mismatches(boards, player, scalar, batch):>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,426 @@
+"""
+Offline throughput benchmark of update ingestion: a fake Telegram Bot API server answers the calls of
+the bot and hands out updates, and PVP games are played by posting synthetic field clicks to the webhook
+server or by queueing them for getUpdates polling of the threaded or the asyncio runtime. Every click waits for the bot to answer it, so the
+time includes handling and the Telegram calls it makes. The fake API runs in its own process, so it
+doesn't take interpreter time from the bot, it can delay its answers like a distant server does and
+answer 429 like Telegram does to chats getting too many calls.
+Run from the repository root: python -m benchmarks.fake_telegram --mode webhook
+"""
+import argparse
+import http.client
+import itertools
+import json
+import multiprocessing
+import os
+import ssl
+import tempfile
+import threading
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+import telebot
+
+import config
+from models.base import db
+
+SECRET_TOKEN = 'benchmark-secret'
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    """
+    Answers Bot API calls made to /bot<token>/<method>, parameters come in the query string or the body,
+    and calls of the benchmark made to /control/<method>
+    """
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written apart, waiting for their ACKs would add 40ms to every call
+    disable_nagle_algorithm = True
+    server: 'FakeTelegram'
+
+    def do_GET(self):
+        self.handle_call()
+
+    def do_POST(self):
+        self.handle_call()
+
+    def handle_call(self):
+        url = urlparse(self.path)
+        method = url.path.rsplit('/', 1)[-1]
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+
+        status = 200
+        if url.path.startswith('/control/'):
+            answer = {'ok': True, 'result': self.server.control(method, params, body)}
+        else:
+            params.update(parse_qsl(body))
+            try:
+                answer = {'ok': True, 'result': self.server.call(method, params)}
+            except FloodError:
+                status = 429
+                answer = {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                          'parameters': {'retry_after': 1}}
+
+        data = json.dumps(answer).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FloodError(Exception):
+    pass
+
+
+class FakeTelegram(ThreadingHTTPServer):
+    """
+    Fake Bot API keeping what the benchmark needs: message ids of boards sent to every chat, answered
+    callback queries, numbers of sent messages and updates waiting for getUpdates
+    """
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency: float = 0, flood_limit: int = 0):
+        super().__init__(address, FakeTelegramHandler)
+        self.latency = latency
+        self.flood_limit = flood_limit
+        # times of the last calls to every chat
+        self.chat_calls: Dict[int, deque] = {}
+        self.floods = 0
+        self.changed = threading.Condition()
+        self.message_ids = itertools.count(1000)
+        self.boards: Dict[int, int] = {}
+        self.answered = set()
+        self.messages = Counter()
+        self.updates: List[dict] = []
+        # ids are given when updates are queued, players numbering them could queue them out of order
+        # and getUpdates would skip the ones behind its offset
+        self.update_ids = itertools.count(1)
+        self.calls = 0
+
+    def wait(self, ready: Callable[[], bool], timeout: float) -> bool:
+        with self.changed:
+            return self.changed.wait_for(ready, timeout)
+
+    def call(self, method: str, params: dict):
+        with self.changed:
+            self.calls += 1
+
+        if method == 'getUpdates':
+            offset = int(params.get('offset', 0))
+            with self.changed:
+                self.changed.wait_for(lambda: any(u['update_id'] >= offset for u in self.updates),
+                                      float(params.get('timeout', 0)))
+                self.updates = [update for update in self.updates if update['update_id'] >= offset]
+                return list(self.updates)
+        sleep(self.latency)
+        if self.flood_limit and 'chat_id' in params:
+            self.check_flood(int(params['chat_id']))
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bot', 'username': 'bot'}
+        if method == 'sendMessage':
+            chat_id = int(params['chat_id'])
+            message_id = next(self.message_ids)
+            with self.changed:
+                # boards are the messages with field buttons
+                if '"0-0"' in params.get('reply_markup', ''):
+                    self.boards[chat_id] = message_id
+                self.messages[chat_id, params.get('text', '')] += 1
+                self.changed.notify_all()
+            return message(chat_id, message_id, params.get('text', ''))
+        if method == 'answerCallbackQuery':
+            with self.changed:
+                self.answered.add(params['callback_query_id'])
+                self.changed.notify_all()
+        # edits, deletions and webhook settings
+        return True
+
+    def check_flood(self, chat_id: int) -> None:
+        """
+        :raises FloodError: when the chat got flood_limit calls in the last second
+        """
+        now = monotonic()
+        with self.changed:
+            calls = self.chat_calls.setdefault(chat_id, deque())
+            while calls and calls[0] < now - 1:
+                calls.popleft()
+            if len(calls) >= self.flood_limit:
+                self.floods += 1
+                raise FloodError()
+            calls.append(now)
+
+    def control(self, method: str, params: dict, body: str):
+        timeout = float(params.get('timeout', 0))
+        if method == 'board':
+            with self.changed:
+                return self.boards.get(int(params['chat_id']))
+        if method == 'messages':
+            with self.changed:
+                return self.messages[int(params['chat_id']), params['text']]
+        if method == 'wait_messages':
+            key = int(params['chat_id']), params['text']
+            return self.wait(lambda: self.messages[key] >= int(params['count']), timeout)
+        if method == 'wait_answer':
+            return self.wait(lambda: params['id'] in self.answered, timeout)
+        if method == 'push_update':
+            update = json.loads(body)
+            with self.changed:
+                update['update_id'] = next(self.update_ids)
+                self.updates.append(update)
+                self.changed.notify_all()
+            return True
+        if method == 'calls':
+            return self.calls
+        if method == 'floods':
+            return self.floods
+        raise ValueError(f'Unknown control method {method}')
+
+
+def serve(ports: multiprocessing.Queue, latency: float = 0, flood_limit: int = 0,
+          certificate: Optional[str] = None) -> None:
+    """
+    Runs the fake API in a process of its own, its port is put to ports
+    :param latency: seconds every call but getUpdates takes
+    :param flood_limit: calls a chat gets a second before the rest is answered with 429, 0 for no limit
+    :param certificate: PEM file of a certificate and its key to serve HTTPS with
+    """
+    server = FakeTelegram(latency=latency, flood_limit=flood_limit)
+    if certificate:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certificate)
+        # handshakes are made in connection threads, not in the one accepting connections
+        server.socket = context.wrap_socket(server.socket, server_side=True, do_handshake_on_connect=False)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+class FakeTelegramClient:
+    """
+    Talks to the control endpoints of the fake API over a kept alive connection per thread
+    """
+
+    def __init__(self, port: int):
+        self.port = port
+        self.local = threading.local()
+
+    @property
+    def api_url(self) -> str:
+        return f'http://127.0.0.1:{self.port}/bot{{0}}/{{1}}'
+
+    def request(self, method: str, body: str = '', **params):
+        if not hasattr(self.local, 'connection'):
+            self.local.connection = http.client.HTTPConnection('127.0.0.1', self.port)
+        self.local.connection.request('POST', f'/control/{method}?{urlencode(params)}', body)
+        response = self.local.connection.getresponse()
+        return json.loads(response.read())['result']
+
+    def board(self, chat_id: int) -> int:
+        return self.request('board', chat_id=chat_id)
+
+    def messages(self, chat_id: int, text: str) -> int:
+        return self.request('messages', chat_id=chat_id, text=text)
+
+    def wait_messages(self, chat_id: int, text: str, count: int, timeout: float) -> bool:
+        return self.request('wait_messages', chat_id=chat_id, text=text, count=count, timeout=timeout)
+
+    def wait_answer(self, callback_id: str, timeout: float) -> bool:
+        return self.request('wait_answer', id=callback_id, timeout=timeout)
+
+    def push_update(self, update: dict) -> None:
+        self.request('push_update', json.dumps(update))
+
+    def calls(self) -> int:
+        return self.request('calls')
+
+    def floods(self) -> int:
+        return self.request('floods')
+
+
+def message(chat_id: int, message_id: int, text: str = '') -> dict:
+    return {'message_id': message_id, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}, 'text': text}
+
+
+_update_ids = itertools.count(1)
+
+
+def click_update(user_id: int, message_id: int, data: str) -> dict:
+    update_id = next(_update_ids)
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': message(user_id, message_id),
+        }
+    }
+
+
+class WebhookPoster:
+    """
+    Posts updates to the webhook server over a kept alive connection per thread
+    """
+
+    def __init__(self, port: int, path: str):
+        self.port = port
+        self.path = path
+        self.local = threading.local()
+
+    def post(self, update: dict) -> None:
+        if not hasattr(self.local, 'connection'):
+            self.local.connection = http.client.HTTPConnection('127.0.0.1', self.port)
+        self.local.connection.request('POST', self.path, json.dumps(update), {
+            'Content-Type': 'application/json',
+            'X-Telegram-Bot-Api-Secret-Token': SECRET_TOKEN,
+        })
+        response = self.local.connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f'Webhook answered {response.status}')
+
+
+def play(utils, bot, telegram: FakeTelegramClient, send: Callable[[dict], None], first: int, second: int,
+         games: int, latencies: List[float], errors: List[Exception]) -> None:
+    """
+    Plays PVP games between first and second, first player wins every game with the seventh click
+    :param send: delivers an update to the bot
+    """
+    from models import states
+
+    for _ in range(games):
+        users = [utils.get_user_or_none(telebot.types.User(user_id, False, f'user{user_id}'))
+                 for user_id in (first, second)]
+        for user in users:
+            user.state = states.USER_IN_PVP_GAME
+            utils.update_user(user)
+        # the game is over when the loser is told so, users are back in menu by then
+        lost = telegram.messages(second, 'Oh. You lost.')
+        utils.new_game_from2(bot, *users)
+        boards = {user_id: telegram.board(user_id) for user_id in (first, second)}
+
+        for turn in range(7):
+            user_id = (first, second)[turn % 2]
+            update = click_update(user_id, boards[user_id], f'0-{3 if turn % 2 == 0 else 4}')
+            start = monotonic()
+            try:
+                send(update)
+                if not telegram.wait_answer(update['callback_query']['id'], timeout=30):
+                    raise RuntimeError(f'Click of {user_id} was not answered')
+            except Exception as e:
+                errors.append(e)
+                return
+            latencies.append(monotonic() - start)
+
+        if not telegram.wait_messages(second, 'Oh. You lost.', lost + 1, timeout=30):
+            errors.append(RuntimeError(f'Game of {first} and {second} did not end'))
+            return
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--mode', choices=['polling', 'webhook', 'async'], default='webhook')
+    parser.add_argument('--pairs', type=int, default=16, help='games played at once')
+    parser.add_argument('--games', type=int, default=5, help='games of every pair')
+    parser.add_argument('--workers', type=int, default=config.DISPATCH_SHARDS, help='dispatcher shards or async workers')
+    parser.add_argument('--api-latency', type=float, default=0, help='milliseconds every API call takes')
+    parser.add_argument('--flood-limit', type=int, default=0, help='calls a chat gets a second before 429')
+    parser.add_argument('--outbound', action='store_true', help='make calls through the flood limits of the bot')
+    args = parser.parse_args()
+    if config.DB_BACKEND != 'sqlite':
+        parser.error('the benchmark runs on a temporary SQLite database, set config.DB_BACKEND to sqlite')
+
+    ports = multiprocessing.Queue()
+    api = multiprocessing.Process(target=serve, args=(ports, args.api_latency / 1000, args.flood_limit), daemon=True)
+    api.start()
+    telegram = FakeTelegramClient(ports.get(timeout=10))
+    telebot.apihelper.API_URL = telegram.api_url
+
+    directory = tempfile.mkdtemp()
+    db.init(os.path.join(directory, 'db.sqlite'), pragmas=config.DB_PRAGMAS, timeout=config.DB_TIMEOUT)
+
+    # bot module creates its client on import, a token of valid format is enough for the fake API
+    config.TOKEN = '0:benchmark'
+    import bot
+    import migrations
+    import utils
+    import outbound
+    import webhook
+    from dispatcher import ShardedDispatcher
+
+    migrations.migrate_database()
+    if args.outbound:
+        outbound.install()
+    for user_id in range(2 * args.pairs):
+        utils.save_user(telebot.types.User(user_id, False, f'user{user_id}'))
+
+    server: Optional[webhook.WebhookServer] = None
+    dispatcher: Optional[ShardedDispatcher] = None
+    runtime = None
+    if args.mode == 'webhook':
+        dispatcher = ShardedDispatcher(bot.bot, shards=args.workers)
+        server = webhook.WebhookServer(dispatcher, ('127.0.0.1', 0), '/webhook', SECRET_TOKEN)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        send = WebhookPoster(server.server_address[1], '/webhook').post
+        workers = f'{args.workers} shards'
+    elif args.mode == 'async':
+        import async_runtime
+        telebot.asyncio_helper.API_URL = telegram.api_url
+
+        runtime = async_runtime.AsyncRuntime(
+            bot.bot, workers=args.workers, limiter=outbound.get_limiter() if args.outbound else None
+        )
+        threading.Thread(target=runtime.run, daemon=True).start()
+        send = telegram.push_update
+        workers = f'{args.workers} workers'
+    else:
+        dispatcher = ShardedDispatcher(bot.bot, shards=args.workers)
+        threading.Thread(target=dispatcher.poll, daemon=True).start()
+        send = telegram.push_update
+        workers = f'{args.workers} shards'
+
+    latencies, errors = [], []
+    threads = [
+        threading.Thread(target=play, args=(utils, bot.bot, telegram, send, 2 * i, 2 * i + 1, args.games,
+                                            latencies, errors))
+        for i in range(args.pairs)
+    ]
+    start = monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = monotonic() - start
+
+    if server:
+        server.shutdown()
+        server.server_close()
+    elif runtime:
+        runtime.stop()
+    else:
+        dispatcher.stop()
+
+    latencies.sort()
+    print(f'{args.mode}, {workers}: {len(latencies)} clicks of {args.pairs} games at once in {elapsed:.2f}s, '
+          f'{len(latencies) / elapsed:.0f} clicks/s, {len(errors)} failed')
+    if latencies:
+        print(f'click latency p50 {latencies[len(latencies) // 2] * 1000:.1f}ms '
+              f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms, {telegram.calls()} API calls, '
+              f'{telegram.floods()} answered with 429')
+    if args.outbound:
+        print(outbound.get_limiter().report())
+    if dispatcher:
+        print(dispatcher.report())
+    for error in errors[:3]:
+        print(f'  {type(error).__name__}: {error}')
+
+
+if __name__ == '__main__':
+    main()
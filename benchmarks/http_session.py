@@ -0,0 +1,115 @@
+"""
+Compares HTTP clients of Telegram calls against the fake Bot API of benchmarks.fake_telegram: threads
+send messages as fast as they can through telebot's default session per thread, a new connection per
+call, or the shared pool of outbound. Threads are replaced after --thread-calls calls, as AI callback and
+other short lived threads are, which costs telebot's sessions their connections.
+Run from the repository root: python -m benchmarks.http_session --tls
+"""
+import argparse
+import multiprocessing
+import os
+import subprocess
+import tempfile
+import threading
+from time import monotonic
+
+import requests
+import telebot
+
+from benchmarks.fake_telegram import serve
+
+CLIENTS = ['telebot', 'fresh', 'pooled']
+
+
+def make_certificate(directory: str) -> str:
+    """
+    :return: PEM file of a self-signed certificate of 127.0.0.1 and its key
+    """
+    path = os.path.join(directory, 'localhost.pem')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=127.0.0.1',
+         '-addext', 'subjectAltName=IP:127.0.0.1', '-keyout', path, '-out', path],
+        check=True, capture_output=True
+    )
+    return path
+
+
+def install(client: str) -> None:
+    import outbound
+
+    if client == 'telebot':
+        telebot.apihelper.CUSTOM_REQUEST_SENDER = None
+    elif client == 'fresh':
+        # requests.request makes a session, and so a connection, for every call
+        telebot.apihelper.CUSTOM_REQUEST_SENDER = requests.request
+    else:
+        # limits far above the calls made, only the session is measured
+        limiter = outbound.RateLimiter(rate=1e9, burst=10 ** 9, chat_rate=1e9, chat_burst=10 ** 9)
+        telebot.apihelper.CUSTOM_REQUEST_SENDER = outbound.OutboundSender(limiter)
+
+
+def run(bot: telebot.TeleBot, threads: int, calls: int, thread_calls: int) -> float:
+    """
+    Sends calls messages from threads at once, every thread making thread_calls of them
+    :return: calls a second
+    """
+    left = [calls]
+    lock = threading.Lock()
+
+    def send(chat_id: int) -> None:
+        for _ in range(thread_calls):
+            with lock:
+                if not left[0]:
+                    return
+                left[0] -= 1
+            bot.send_message(chat_id, 'ping')
+
+    def worker(chat_id: int) -> None:
+        # a new thread for every thread_calls calls
+        while left[0]:
+            thread = threading.Thread(target=send, args=(chat_id,))
+            thread.start()
+            thread.join()
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = monotonic()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return calls / (monotonic() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--thread-calls', type=int, default=20, help='calls a thread makes before it is replaced')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds every API call takes')
+    parser.add_argument('--tls', action='store_true', help='serve the fake API over HTTPS')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    certificate = make_certificate(directory) if args.tls else None
+    if certificate:
+        # trusted by every requests session, telebot's ones included
+        os.environ['REQUESTS_CA_BUNDLE'] = certificate
+
+    ports = multiprocessing.Queue()
+    api = multiprocessing.Process(target=serve, args=(ports, args.latency / 1000, 0, certificate), daemon=True)
+    api.start()
+    scheme = 'https' if certificate else 'http'
+    telebot.apihelper.API_URL = f'{scheme}://127.0.0.1:{ports.get(timeout=10)}/bot{{0}}/{{1}}'
+    bot = telebot.TeleBot('0:benchmark')
+
+    print(f'{args.calls} sendMessage calls from {args.threads} threads over {scheme}, '
+          f'threads replaced every {args.thread_calls} calls')
+    for client in CLIENTS:
+        install(client)
+        # the first run warms up the fake API and the pool
+        run(bot, args.threads, args.threads, 1)
+        print(f'{client:>8}: {run(bot, args.threads, args.calls, args.thread_calls):.0f} calls/s')
+
+
+if __name__ == '__main__':
+    main()
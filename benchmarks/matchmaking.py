@@ -0,0 +1,94 @@
+"""
+Has many players look for PVP games at once from several threads on a temporary database and checks
+that everyone is paired exactly once, then times the queue out for a player left alone.
+Run from the repository root: python -m benchmarks.matchmaking --players 200
+"""
+import argparse
+import os
+import tempfile
+import threading
+from collections import Counter
+from time import monotonic, sleep
+
+import config
+from benchmarks.queries import StubBot, tg_user
+from models.base import connection, db
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--players', type=int, default=200, help='odd numbers leave a player to time out')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--timeout', type=float, default=2, help='matchmaking timeout, seconds')
+    args = parser.parse_args()
+    if config.DB_BACKEND != 'sqlite':
+        parser.error('the benchmark runs on a temporary SQLite database, set config.DB_BACKEND to sqlite')
+
+    directory = tempfile.mkdtemp()
+    db.init(os.path.join(directory, 'db.sqlite'), pragmas=config.DB_PRAGMAS, timeout=config.DB_TIMEOUT)
+    config.MATCHMAKING_TIMEOUT = args.timeout
+
+    import matchmaking
+    import migrations
+    import utils
+    from models import states
+    from models.game import Game
+    from models.user import User
+
+    migrations.migrate_database()
+    bot = StubBot()
+    for user_id in range(args.players):
+        utils.save_user(tg_user(user_id))
+
+    latencies = []
+    errors = []
+    start_barrier = threading.Barrier(args.threads)
+
+    def play(user_ids):
+        start_barrier.wait()
+        for user_id in user_ids:
+            try:
+                start = monotonic()
+                with connection():
+                    utils.start_new_game(bot, tg_user(user_id), 'person')
+                latencies.append(monotonic() - start)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=play, args=(range(i, args.players, args.threads),))
+               for i in range(args.threads)]
+    start = monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = monotonic() - start
+
+    games = list(Game.select())
+    players = Counter(user for game in games for user in (game.user1_id, game.user2_id) if user)
+    running = sum(game.state == states.RUNNING_GAME for game in games)
+    waiting = sum(game.state == states.MATCHMAKING_GAME for game in games)
+    latencies.sort()
+    print(f'{args.players} players in {args.threads} threads joined in {elapsed:.2f}s, '
+          f'{len(errors)} failed, join p50 {latencies[len(latencies) // 2] * 1000:.1f}ms '
+          f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms')
+    print(f'running games: {running}, waiting games: {waiting}, queued: {len(matchmaking.get_queue())}, '
+          f'players in several games: {sum(count > 1 for count in players.values())}, '
+          f'players in no game: {args.players - len(players)}')
+
+    if waiting:
+        # the sweeper checks for timeouts every MATCHMAKING_SWEEP_INTERVAL seconds
+        sleep(args.timeout + 2 * config.MATCHMAKING_SWEEP_INTERVAL)
+        left = User.select().where(User.state == states.USER_IN_PVP_GAME).count() - 2 * running
+        print(f'after timeout: waiting games: {Game.select().where(Game.state == states.MATCHMAKING_GAME).count()}, '
+              f'players still searching: {left}')
+
+    queue = matchmaking.get_queue()
+    with queue.lock:
+        print(queue.histogram.report())
+    for error in errors[:3]:
+        print(f'  {type(error).__name__}: {error}')
+
+
+if __name__ == '__main__':
+    main()
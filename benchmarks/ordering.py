@@ -0,0 +1,65 @@
+"""
+Compares the number of searched nodes with and without move ordering.
+Run from the repository root: python -m benchmarks.ordering
+"""
+import argparse
+import random
+from time import monotonic
+
+import ai
+from bitboard import Position
+from config import AI_PLAYER, HUMAN_PLAYER
+from transposition import TranspositionTable
+
+
+def random_positions(count: int, plies: int, seed: int):
+    """
+    :return: count positions reached by plies random moves, human moving first
+    """
+    rng = random.Random(seed)
+    positions = []
+    while len(positions) < count:
+        position = Position()
+        for ply in range(plies):
+            position.play(rng.choice(position.legal_moves()), HUMAN_PLAYER if ply % 2 == 0 else AI_PLAYER)
+        if not ai.position_is_over(position):
+            # search starts from a position without history
+            positions.append(Position.from_board(position.to_board()))
+    return positions
+
+
+def measure(positions, depth: int, ordering: bool):
+    """
+    :return: total nodes and seconds of fixed-depth searches of all positions
+    """
+    nodes = 0
+    start = monotonic()
+    for position in positions:
+        context = ai.SearchContext(TranspositionTable(), ordering=ordering)
+        moves = ai.root_moves(position) if ordering else position.legal_moves()
+        ai.search_root(position, moves, depth, AI_PLAYER, context)
+        nodes += context.nodes
+    return nodes, monotonic() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--depth', type=int, default=6)
+    parser.add_argument('--positions', type=int, default=50)
+    parser.add_argument('--plies', type=int, default=7)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    positions = random_positions(args.positions, args.plies, args.seed)
+
+    plain_nodes, plain_time = measure(positions, args.depth, ordering=False)
+    ordered_nodes, ordered_time = measure(positions, args.depth, ordering=True)
+
+    print(f'{len(positions)} positions after {args.plies} plies, depth {args.depth}')
+    print(f'left to right: {plain_nodes:>10} nodes {plain_time:8.2f}s')
+    print(f'ordered:       {ordered_nodes:>10} nodes {ordered_time:8.2f}s')
+    print(f'nodes saved:   {1 - ordered_nodes / plain_nodes:>10.1%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+Counts database queries made while handling bot updates: a PVP game and an AI game are played
+through the bot handlers on a temporary database, with Telegram calls replaced by a stub.
+Run from the repository root: python -m benchmarks.queries
+"""
+import argparse
+import itertools
+import os
+import tempfile
+import threading
+from types import SimpleNamespace
+
+import codec
+import config
+from models.base import db
+
+_message_ids = itertools.count(1)
+
+
+class StubBot:
+    """
+    Answers the Telegram calls made by handlers without sending anything
+    """
+
+    def send_message(self, chat_id, text, **kwargs):
+        return SimpleNamespace(message_id=next(_message_ids), chat=SimpleNamespace(id=chat_id), text=text)
+
+    def reply_to(self, message, text, **kwargs):
+        return self.send_message(message.chat.id, text)
+
+    def __getattr__(self, name):
+        # edit_message_text, delete_message, answer_callback_query...
+        return lambda *args, **kwargs: None
+
+
+def tg_user(user_id: int):
+    return SimpleNamespace(id=user_id, first_name=f'user{user_id}')
+
+
+def callback(user_id: int, message_id: int, data: str):
+    return SimpleNamespace(
+        id=str(next(_message_ids)),
+        from_user=tg_user(user_id),
+        data=data,
+        message=SimpleNamespace(message_id=message_id, text='')
+    )
+
+
+class Counter:
+    """
+    Collects numbers of queries made by updates of every kind, every update starting with empty cache
+    """
+
+    def __init__(self, utils):
+        self.utils = utils
+        self.counts = {}
+
+    def measure(self, kind: str, action):
+        self.utils.clear_cache()
+        before = db.queries
+        action()
+        self.counts.setdefault(kind, []).append(db.queries - before)
+
+    def report(self):
+        for kind, counts in self.counts.items():
+            print(f'{kind:<24} {len(counts):>4} updates {sum(counts) / len(counts):>6.1f} queries per update')
+
+
+def play_pvp(dispatcher, utils, counter: Counter, first: int, second: int) -> None:
+    from models.game import Game
+
+    for user_id in (first, second):
+        counter.measure('menu click', lambda: dispatcher.process_new_callback_query([
+            callback(user_id, 0, 'person')
+        ]))
+
+    # first player builds a vertical four in column 3, second one plays column 4
+    for turn in range(7):
+        user_id = first if turn % 2 == 0 else second
+        game = utils.get_users_game(utils.get_user_or_none(tg_user(user_id)))
+        message_id = game.message1 if user_id == first else game.message2
+        col = 3 if turn % 2 == 0 else 4
+        counter.measure('pvp field click', lambda: dispatcher.process_new_callback_query([
+            callback(user_id, message_id, f'0-{col}')
+        ]))
+
+    assert not Game.select().exists(), 'PVP game did not end'
+
+
+def play_ai(dispatcher, utils, counter: Counter, user_id: int, level: str) -> None:
+    counter.measure('menu click', lambda: dispatcher.process_new_callback_query([callback(user_id, 0, 'ai')]))
+    counter.measure('ai level click', lambda: dispatcher.process_new_callback_query([callback(user_id, 0, level)]))
+
+    # AI move is made in a callback thread, counted together with the click it answers;
+    # the turn is over when AI has moved or the click has ended the game
+    finished = threading.Event()
+    handlers = {name: getattr(utils, name) for name in ('handle_ai_move', 'handle_win', 'handle_draw')}
+
+    def notifying(handler):
+        def handle(*args):
+            try:
+                handler(*args)
+            finally:
+                finished.set()
+        return handle
+
+    for name, handler in handlers.items():
+        setattr(utils, name, notifying(handler))
+
+    try:
+        for col in itertools.cycle(range(config.COLS)):
+            game = utils.get_users_game(utils.get_user_or_none(tg_user(user_id)))
+            if not game:
+                break
+            if codec.decode_field(game.field)[0][col]:
+                continue
+
+            def turn():
+                finished.clear()
+                dispatcher.process_new_callback_query([callback(user_id, game.message1, f'0-{col}')])
+                if not finished.wait(timeout=30):
+                    raise RuntimeError('AI did not move')
+
+            counter.measure('ai turn (click + move)', turn)
+    finally:
+        for name, handler in handlers.items():
+            setattr(utils, name, handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--games', type=int, default=3)
+    parser.add_argument('--level', default='s', choices=sorted(config.AI_LEVELS))
+    args = parser.parse_args()
+    if config.DB_BACKEND != 'sqlite':
+        parser.error('the benchmark runs on a temporary SQLite database, set config.DB_BACKEND to sqlite')
+
+    directory = tempfile.mkdtemp()
+    db.init(os.path.join(directory, 'db.sqlite'))
+
+    # bot module creates its client on import, a token of valid format is enough as nothing is sent
+    config.TOKEN = '0:benchmark'
+    import bot
+    import ai_service
+    import migrations
+    import utils
+
+    migrations.migrate_database()
+
+    dispatcher = bot.bot
+    dispatcher.threaded = False
+    bot.bot = StubBot()
+
+    counter = Counter(utils)
+    for game in range(args.games):
+        for user_id in (1, 2, 3 + game):
+            utils.save_user(tg_user(user_id))
+        play_pvp(dispatcher, utils, counter, 1, 2)
+        play_ai(dispatcher, utils, counter, 3 + game, args.level)
+
+    ai_service.get_service().shutdown()
+    counter.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+Checks that the AI treats a position and its mirror image alike now that the transposition table and the
+opening book are keyed by mirror-canonical positions: searches of mirrored boards must give the same scores
+and mirrored moves, and the book must answer a mirrored position with the mirrored move.
+Run from the repository root: python -m benchmarks.symmetry
+"""
+import argparse
+import os
+import random
+import tempfile
+
+import ai
+import book
+from bitboard import Position, mirror_board, mirror_move
+from config import AI_PLAYER, COLS, HUMAN_PLAYER, ROWS
+from evaluation import EvaluatedPosition
+from transposition import TranspositionTable
+
+
+def random_boards(count: int, seed: int):
+    """
+    :return: count boards of random games stopped at a random ply before any four, with the player to move
+    """
+    rng = random.Random(seed)
+    boards = []
+    while len(boards) < count:
+        position = Position()
+        player = HUMAN_PLAYER
+        for _ in range(rng.randint(0, ROWS * COLS - 1)):
+            position.play(rng.choice(position.legal_moves()), player)
+            if position.is_won(player):
+                position.undo()
+                break
+            player = AI_PLAYER if player == HUMAN_PLAYER else HUMAN_PLAYER
+        boards.append((position.to_board(), player))
+    return boards
+
+
+def search(board, depth: int, player: int, valid_moves, table: TranspositionTable):
+    """
+    :return: move and score of search_root for board, searching root moves in given order
+    """
+    table.new_search()
+    position = EvaluatedPosition.from_board(board)
+    return ai.search_root(position, list(valid_moves), depth, player, ai.SearchContext(table))
+
+
+def search_mismatches(boards, depth: int, shared: bool) -> int:
+    """
+    :param shared: whether the mirrored board is searched with the table of the original one,
+    so it is answered from entries of mirror-canonical keys stored by the first search
+    :return: number of boards whose mirror image gets another score or a move other than the mirrored one
+    """
+    count = 0
+    for board, player in boards:
+        valid_moves = ai.root_moves(EvaluatedPosition.from_board(board))
+        table = TranspositionTable()
+        move, score = search(board, depth, player, valid_moves, table)
+        mirrored_move, mirrored_score = search(
+            mirror_board(board), depth, player, [mirror_move(col) for col in valid_moves],
+            table if shared else TranspositionTable()
+        )
+        if mirrored_score != score or mirrored_move != mirror_move(move):
+            count += 1
+    return count
+
+
+def book_positions(plies: int):
+    """
+    :return: positions with AI to move reached by every sequence of moves shorter than plies, both
+    orientations of mirrored pairs included
+    """
+    positions = {}
+    frontier = [Position()]
+    for ply in range(plies - 1):
+        player = HUMAN_PLAYER if ply % 2 == 0 else AI_PLAYER
+        next_frontier = []
+        for position in frontier:
+            for col in position.legal_moves():
+                child = Position.from_board(position.to_board())
+                child.play(col, player)
+                if child.code() in positions or child.is_won(player):
+                    continue
+                next_frontier.append(child)
+                if player == HUMAN_PLAYER:
+                    positions[child.code()] = child
+        frontier = next_frontier
+    return list(positions.values())
+
+
+def book_mismatches(plies: int, depth: int, workers: int):
+    """
+    Writes a small book and looks up every position it may have a move for and its mirror image
+    :return: positions looked up, positions found & number of mirror images of asymmetric positions
+    answered with another move than the mirrored one
+    """
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'book.bin')
+    book.write_book(path, book.generate(plies, depth, workers))
+    opening_book = book.OpeningBook(path)
+    try:
+        looked_up = found = count = 0
+        for position in book_positions(plies):
+            move = opening_book.lookup(position)
+            looked_up += 1
+            found += move is not None
+            if position.code() == position.mirrored_code():
+                # its own mirror image, either of mirrored moves is as good
+                continue
+            mirrored_move = opening_book.lookup(Position.from_board(mirror_board(position.to_board())))
+            if mirrored_move != (mirror_move(move) if move is not None else None):
+                count += 1
+        return looked_up, found, count
+    finally:
+        opening_book.close()
+        os.remove(path)
+        os.rmdir(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--boards', type=int, default=200)
+    parser.add_argument('--max-depth', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--book-plies', type=int, default=6)
+    parser.add_argument('--book-depth', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    boards = random_boards(args.boards, args.seed)
+    failed = 0
+    for depth in range(1, args.max_depth + 1):
+        fresh = search_mismatches(boards, depth, shared=False)
+        shared = search_mismatches(boards, depth, shared=True)
+        failed += fresh + shared
+        print(f'depth {depth}, {len(boards)} boards: mismatches {fresh} with own tables, {shared} with a shared one')
+
+    looked_up, found, mismatches = book_mismatches(args.book_plies, args.book_depth, args.workers)
+    failed += mismatches
+    print(f'book of {args.book_plies} plies: {found} of {looked_up} positions found, mismatches {mismatches}')
+
+    if failed:
+        raise SystemExit(f'{failed} mismatches')
+
+
+if __name__ == '__main__':
+    main()
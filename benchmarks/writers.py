@@ -0,0 +1,85 @@
+"""
+Measures how many field clicks per second the handlers process when several threads play PVP games
+at once, on a temporary database with the pragmas of config.DB_PRAGMAS or with SQLite defaults.
+Run from the repository root: python -m benchmarks.writers --pragmas tuned
+"""
+import argparse
+import os
+import tempfile
+import threading
+from time import monotonic
+
+import config
+from benchmarks.queries import StubBot, callback, tg_user
+from models.base import db
+
+
+def play(utils, bot, first: int, second: int, clicks: int, errors: list) -> None:
+    """
+    Plays PVP games between first and second until clicks clicks are handled
+    """
+    from models import states
+
+    game = None
+    for click in range(clicks):
+        if game is None or click % 7 == 0:
+            # the first player wins in column 3 with the seventh click, the game is deleted
+            users = [utils.get_user_or_none(tg_user(user_id)) for user_id in (first, second)]
+            for user in users:
+                user.state = states.USER_IN_PVP_GAME
+                utils.update_user(user)
+            utils.new_game_from2(bot, *users)
+            game = utils.get_users_game(users[0])
+
+        turn = click % 7 % 2
+        col = 3 if turn == 0 else 4
+        message_id = game.message1 if turn == 0 else game.message2
+        try:
+            utils.handle_game_field_click(bot, callback((first, second)[turn], message_id, f'0-{col}'))
+        except Exception as e:
+            errors.append(e)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--pragmas', choices=['default', 'tuned'], default='tuned')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--clicks', type=int, default=210, help='clicks of every thread')
+    args = parser.parse_args()
+    if config.DB_BACKEND != 'sqlite':
+        parser.error('the benchmark runs on a temporary SQLite database, set config.DB_BACKEND to sqlite')
+
+    directory = tempfile.mkdtemp()
+    pragmas = config.DB_PRAGMAS if args.pragmas == 'tuned' else {}
+    db.init(os.path.join(directory, 'db.sqlite'), pragmas=pragmas, timeout=config.DB_TIMEOUT)
+
+    import migrations
+    import utils
+
+    migrations.migrate_database()
+    bot = StubBot()
+    for user_id in range(2 * args.threads):
+        utils.save_user(tg_user(user_id))
+
+    errors = []
+    threads = [
+        threading.Thread(target=play, args=(utils, bot, 2 * i, 2 * i + 1, args.clicks, errors))
+        for i in range(args.threads)
+    ]
+    start = monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = monotonic() - start
+
+    clicks = args.threads * args.clicks
+    print(f'pragmas {args.pragmas}: {db.pragma("journal_mode")} journal, synchronous {db.pragma("synchronous")}')
+    print(f'{args.threads} threads, {clicks} clicks in {elapsed:.2f}s: {clicks / elapsed:.0f} clicks/s, '
+          f'{len(errors)} failed')
+    for error in errors[:3]:
+        print(f'  {type(error).__name__}: {error}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+from random import Random
+from typing import List, Optional, Tuple
+
+from config import COLS, ROWS
+
+# every column takes ROWS + 1 bits, the extra (always empty) bit on top
+# separates columns so that shifted lines can not wrap around the board
+HEIGHT = ROWS + 1
+
+# bit offsets between neighbouring cells of a line
+VERTICAL = 1
+HORIZONTAL = HEIGHT
+DIAGONAL_DOWN = HEIGHT - 1  # towards bigger row index (down) and bigger col index
+DIAGONAL_UP = HEIGHT + 1  # towards smaller row index (up) and bigger col index
+
+DIRECTIONS = (VERTICAL, HORIZONTAL, DIAGONAL_DOWN, DIAGONAL_UP)
+
+COLUMN_MASK = (1 << HEIGHT) - 1
+BOTTOM_MASK = sum(1 << (col * HEIGHT) for col in range(COLS))
+
+# bit of the cell reflected left to right, for every bit
+MIRROR_BIT = [(COLS - 1 - bit // HEIGHT) * HEIGHT + bit % HEIGHT for bit in range(COLS * HEIGHT)]
+
+# Zobrist keys of a stone of each player on each bit, seeded so keys are the same in every process
+_random = Random(0xC4)
+ZOBRIST = [[0] * (COLS * HEIGHT)] + [[_random.getrandbits(64) for _ in range(COLS * HEIGHT)] for _ in range(2)]
+
+
+def cell_bit(row: int, col: int) -> int:
+    """
+    :param row: row index in list-of-lists board (0 is the top one)
+    :param col: column index
+    :return: index of bit representing the cell
+    """
+    return col * HEIGHT + ROWS - 1 - row
+
+
+def popcount(bits: int) -> int:
+    return bin(bits).count('1')
+
+
+def shift(bits: int, offset: int) -> int:
+    """
+    :return: bitboard where bit i is the bit i + offset of given bits
+    """
+    return bits >> offset if offset >= 0 else bits << -offset
+
+
+def mirror_move(col: int) -> int:
+    """
+    :return: column reflected left to right
+    """
+    return COLS - 1 - col
+
+
+def orient_move(col: Optional[int], mirrored: bool) -> Optional[int]:
+    """
+    Converts a move between a position and its canonical form, both ways
+    :param col: move or None
+    :param mirrored: whether canonical form is the mirror image of the position
+    """
+    return mirror_move(col) if mirrored and col is not None else col
+
+
+def mirror_board(board: List[List[int]]) -> List[List[int]]:
+    """
+    :return: list-of-lists board reflected left to right
+    """
+    return [list(reversed(row)) for row in board]
+
+
+def mirror(bits: int) -> int:
+    """
+    :return: bitboard reflected left to right
+    """
+    mirrored = 0
+    for col in range(COLS):
+        mirrored |= (bits >> (col * HEIGHT) & COLUMN_MASK) << ((COLS - 1 - col) * HEIGHT)
+    return mirrored
+
+
+def position_code(stones: int, mask: int) -> int:
+    """
+    Unique number of position that fits in 64 bits: each column holds the stones of one player
+    and a marker bit right above the top stone
+    :param stones: bitboard of first player's stones
+    :param mask: bitboard of all stones
+    """
+    return stones + mask + BOTTOM_MASK
+
+
+def has_four(bits: int) -> bool:
+    """
+    Checks bitboard of one player for four stones in a row in any direction
+    :param bits: bitboard of player's stones
+    :return: True if there is a four-in-a-row
+    """
+    for step in DIRECTIONS:
+        pairs = bits & (bits >> step)
+        if pairs & (pairs >> 2 * step):
+            return True
+    return False
+
+
+def sequence_counts(bits: int) -> Tuple[int, int, int]:
+    """
+    Counts sequences the same way ai.count_sequence does: every stone that starts a run of
+    at least 2, 3 or 4 stones going down, right, down-right or up-right
+    :param bits: bitboard of player's stones
+    :return: counts of sequences of length 2, 3 and 4
+    """
+    twos = threes = fours = 0
+    for step in (-VERTICAL, HORIZONTAL, DIAGONAL_DOWN, DIAGONAL_UP):
+        runs = bits & shift(bits, step)
+        twos += popcount(runs)
+        runs &= shift(bits, 2 * step)
+        threes += popcount(runs)
+        runs &= shift(bits, 3 * step)
+        fours += popcount(runs)
+    return twos, threes, fours
+
+
+class Position:
+    """
+    Bitboard representation of a board: one integer of stones per player and the next free
+    bit of each column. Moves are made and taken back in place.
+    """
+
+    def __init__(self):
+        # indexed by player number, 0 is unused
+        self.boards = [0, 0, 0]
+        self.heights = [col * HEIGHT for col in range(COLS)]
+        self.count = 0
+        self.history = []
+        # Zobrist keys of the position and of its mirror image, updated on every move
+        self.key = 0
+        self.mirror_key = 0
+
+    @classmethod
+    def from_board(cls, board: List[List[int]]) -> 'Position':
+        """
+        :param board: list-of-lists board, row 0 is the top one
+        :return: Position holding the same stones
+        """
+        position = cls()
+        for col in range(COLS):
+            for row in reversed(range(ROWS)):
+                player = board[row][col]
+                if not player:
+                    break
+                position._set(position.heights[col], player)
+                position.heights[col] += 1
+                position.count += 1
+        return position
+
+    def to_board(self) -> List[List[int]]:
+        """
+        :return: list-of-lists board, row 0 is the top one
+        """
+        board = [[0 for _ in range(COLS)] for _ in range(ROWS)]
+        for player in (1, 2):
+            for row in range(ROWS):
+                for col in range(COLS):
+                    if self.boards[player] >> cell_bit(row, col) & 1:
+                        board[row][col] = player
+        return board
+
+    @property
+    def mask(self) -> int:
+        return self.boards[1] | self.boards[2]
+
+    def can_play(self, col: int) -> bool:
+        return self.heights[col] < col * HEIGHT + ROWS
+
+    def legal_moves(self) -> List[int]:
+        return [col for col in range(COLS) if self.can_play(col)]
+
+    def is_full(self) -> bool:
+        return self.count == ROWS * COLS
+
+    def play(self, col: int, player: int) -> int:
+        """
+        Drops a stone of player to col
+        :return: row index (list-of-lists coordinates) where the stone landed
+        """
+        bit = self.heights[col]
+        self._set(bit, player)
+        self.heights[col] = bit + 1
+        self.count += 1
+        self.history.append((col, player))
+        return ROWS - 1 - bit % HEIGHT
+
+    def undo(self) -> Tuple[int, int]:
+        """
+        Takes back the last move made with play
+        :return: (col, player) of the taken back move
+        """
+        col, player = self.history.pop()
+        self.heights[col] -= 1
+        self._clear(self.heights[col], player)
+        self.count -= 1
+        return col, player
+
+    def _set(self, bit: int, player: int) -> None:
+        """
+        Puts a stone of player on bit, subclasses extend it to keep their own state up to date
+        """
+        self.boards[player] |= 1 << bit
+        self.key ^= ZOBRIST[player][bit]
+        self.mirror_key ^= ZOBRIST[player][MIRROR_BIT[bit]]
+
+    def _clear(self, bit: int, player: int) -> None:
+        """
+        Removes a stone of player from bit, reverse of _set
+        """
+        self.boards[player] ^= 1 << bit
+        self.key ^= ZOBRIST[player][bit]
+        self.mirror_key ^= ZOBRIST[player][MIRROR_BIT[bit]]
+
+    def code(self) -> int:
+        return position_code(self.boards[1], self.mask)
+
+    def mirrored_code(self) -> int:
+        """
+        :return: code of the position reflected left to right
+        """
+        return position_code(mirror(self.boards[1]), mirror(self.mask))
+
+    def canonical_code(self) -> Tuple[int, bool]:
+        """
+        Position and its mirror image have the same canonical code
+        :return: smaller of codes of position and its mirror image & whether it is the mirrored one
+        """
+        code = self.code()
+        mirrored = self.mirrored_code()
+        return (mirrored, True) if mirrored < code else (code, False)
+
+    def canonical_key(self) -> Tuple[int, bool]:
+        """
+        Same as canonical_code for Zobrist keys
+        :return: smaller of Zobrist keys of position and its mirror image & whether it is the mirrored one
+        """
+        if self.mirror_key < self.key:
+            return self.mirror_key, True
+        return self.key, False
+
+    def is_won(self, player: int) -> bool:
+        return has_four(self.boards[player])
+
+    def sequence_counts(self, player: int) -> Tuple[int, int, int]:
+        return sequence_counts(self.boards[player])
@@ -0,0 +1,188 @@
+"""
+Opening book: best AI moves for the first plies of a game, precomputed by a deep search.
+The book is an open-addressing hash table of position codes written to a file and memory-mapped,
+so loading it costs nothing and a lookup reads a couple of slots.
+Generate it from the repository root: python -m book --plies 8 --depth 9
+"""
+import argparse
+import mmap
+import os
+import struct
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Dict, List, Optional
+
+import config
+import logger
+from bitboard import Position, orient_move
+from config import AI_PLAYER, COLS, HUMAN_PLAYER
+
+MAGIC = b'TDB1'
+# magic, number of slots, number of entries
+HEADER = struct.Struct('<4sII')
+# position code (0 for empty slot), move
+SLOT = struct.Struct('<QB')
+
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+UINT64_MASK = (1 << 64) - 1
+
+# introducing a logger
+logger = logger.get_logger(__name__)
+
+
+def slot_index(code: int, bits: int) -> int:
+    """
+    :return: first slot to look for code in, of a table with 2 ** bits slots
+    """
+    return ((code * HASH_MULTIPLIER) & UINT64_MASK) >> (64 - bits)
+
+
+class OpeningBook:
+    """
+    Read-only memory-mapped book file
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.size, self.entries = HEADER.unpack_from(self.data)
+        if magic != MAGIC or self.size & (self.size - 1):
+            raise ValueError(f'{path} is not an opening book file')
+        self.bits = self.size.bit_length() - 1
+
+    def lookup(self, position: Position) -> Optional[int]:
+        """
+        :param position: position with AI to move
+        :return: book move for position, None if position is not in the book
+        """
+        code, mirrored = position.canonical_code()
+
+        index = slot_index(code, self.bits)
+        while True:
+            key, move = SLOT.unpack_from(self.data, HEADER.size + index * SLOT.size)
+            if key == 0:
+                return None
+            if key == code:
+                return orient_move(move, mirrored)
+            index = (index + 1) & (self.size - 1)
+
+    def close(self) -> None:
+        self.data.close()
+        self.file.close()
+
+
+def write_book(path: str, entries: Dict[int, int]) -> None:
+    """
+    Writes book file
+    :param path: path of the file
+    :param entries: canonical position code -> move in orientation of the canonical position
+    """
+    # at most half of slots are used so probes stay short
+    size = 8
+    while size < 2 * len(entries):
+        size *= 2
+    bits = size.bit_length() - 1
+
+    slots = [(0, 0)] * size
+    for code, move in entries.items():
+        index = slot_index(code, bits)
+        while slots[index][0]:
+            index = (index + 1) & (size - 1)
+        slots[index] = (code, move)
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, size, len(entries)))
+        for code, move in slots:
+            f.write(SLOT.pack(code, move))
+
+
+_book = None
+_book_loaded = False
+_book_lock = threading.Lock()
+
+
+def get_book() -> Optional[OpeningBook]:
+    """
+    :return: book at config.AI_BOOK_PATH, None when there is no book file
+    """
+    global _book, _book_loaded
+    with _book_lock:
+        if not _book_loaded:
+            _book_loaded = True
+            if os.path.exists(config.AI_BOOK_PATH):
+                _book = OpeningBook(config.AI_BOOK_PATH)
+                logger.info(f'Loaded opening book of {_book.entries} positions.')
+            else:
+                logger.info(f'No opening book at {config.AI_BOOK_PATH}.')
+        return _book
+
+
+def search_book_move(board: List[List[int]], depth: int) -> int:
+    """
+    Runs in a worker process: finds the move to store for board
+    """
+    # imported here as ai looks moves up in the book
+    import ai
+    return ai.minimax_alpha_beta(board, depth, AI_PLAYER, use_book=False)
+
+
+def generate(plies: int, depth: int, workers: int) -> Dict[int, int]:
+    """
+    Searches every position with AI to move that can be reached in a game where AI follows the book
+    :param plies: positions with fewer stones than plies get a book move
+    :param depth: depth of search for every position
+    :param workers: number of processes searching positions
+    :return: entries of the book
+    """
+    entries = {}
+
+    # positions with AI to move of the current ply, one of every mirrored pair
+    frontier = {}
+    for col in range(COLS):
+        position = Position()
+        position.play(col, HUMAN_PLAYER)
+        frontier.setdefault(position.canonical_code()[0], position.to_board())
+
+    ply = 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while frontier and ply < plies:
+            logger.info(f'Searching {len(frontier)} positions of ply {ply}.')
+            boards = list(frontier.values())
+            moves = executor.map(partial(search_book_move, depth=depth), boards)
+
+            frontier = {}
+            for board, move in zip(boards, moves):
+                position = Position.from_board(board)
+                code, mirrored = position.canonical_code()
+                entries[code] = orient_move(move, mirrored)
+
+                position.play(move, AI_PLAYER)
+                if position.is_won(AI_PLAYER):
+                    continue
+                for col in position.legal_moves():
+                    position.play(col, HUMAN_PLAYER)
+                    if not position.is_won(HUMAN_PLAYER) and not position.is_full():
+                        frontier.setdefault(position.canonical_code()[0], position.to_board())
+                    position.undo()
+            ply += 2
+
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--plies', type=int, default=8)
+    parser.add_argument('--depth', type=int, default=9)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--out', default=config.AI_BOOK_PATH)
+    args = parser.parse_args()
+
+    entries = generate(args.plies, args.depth, args.workers)
+    write_book(args.out, entries)
+    logger.info(f'Wrote {len(entries)} positions to {args.out}.')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,54 @@
-import json
 import re
+from typing import Optional
 
 import jsonpickle
 import telebot
+from telebot.handler_backends import BaseMiddleware
 
 import buttons
+import codec
 import config
+import matchmaking
+from dispatcher import ShardedDispatcher
+import migrations
+import outbound
 import utils
+import webhook
 from models import states
+from models.base import acquire_connection, release_connection
 from models.game import Game
 from models.user import User
 import logger
 
-# predefining bot client
-bot = telebot.TeleBot(config.TOKEN)
-
-# creating needed database tables
-User.create_table()
-Game.create_table()
+# predefining bot client, middlewares run in the same thread as handlers of their update
+bot = telebot.TeleBot(config.TOKEN, use_class_middlewares=True)
 
 # introducing a logger
 logger = logger.get_logger(__name__)
 
+# runs handlers in polling and webhook modes, created in bot entry
+update_dispatcher: Optional[ShardedDispatcher] = None
+
+
+class ConnectionMiddleware(BaseMiddleware):
+    """
+    Holds a database connection while an update passes filters and handlers,
+    so pooled connections go back to the pool between updates
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+
+    def pre_process(self, message, data):
+        data['connection_opened'] = acquire_connection()
+
+    def post_process(self, message, data, exception):
+        release_connection(data.get('connection_opened', False))
+
+
+bot.setup_middleware(ConnectionMiddleware())
+
 
 @bot.message_handler(commands=['start'])
 def start(msg: telebot.types.Message):
@@ -123,24 +150,28 @@ def leave(msg: telebot.types.Message):
         # todo log something
         return
 
-    user.state = states.USER_IN_MENU
-    user.losses += 1
-    utils.update_user(user)
+    with utils.atomic():
+        # first, as leaving matchmaking waits for the queue, which may be inserting a game
+        utils.delete_game(game)
+        user.state = states.USER_IN_MENU
+        user.losses += 1
+        utils.update_user(user)
+        if opponent:
+            opponent.state = states.USER_IN_MENU
+            opponent.wins += 1
+            utils.update_user(opponent)
+
     bot.send_message(
         user.user_id,
         'You surrendered.'
     )
-
     if opponent:
-        opponent.state = states.USER_IN_MENU
-        opponent.wins += 1
-        utils.update_user(opponent)
         bot.send_message(
             opponent.user_id,
             'Your opponent surrendered'
         )
 
-    field = json.loads(game.field)
+    field = codec.decode_field(game.field)
     sig = 1 if user == game.user1 else 2
 
     # changes users emojis to poop
@@ -151,7 +182,6 @@ def leave(msg: telebot.types.Message):
 
     if opponent:
         utils.send_updated_field(bot, field, game, opponent)
-    Game.delete_by_id(game.id)
 
 
 @bot.message_handler(commands=['issue'], content_types=['text'])
@@ -242,6 +272,37 @@ def get_games(msg: telebot.types.Message):
     )
 
 
+@bot.message_handler(commands=['get_matchmaking'], func=lambda msg: msg.from_user.id in config.DEV_ID)
+def get_matchmaking(msg: telebot.types.Message):
+    """
+    Handles /get_matchmaking query - sends back the number of waiting players and the wait time histogram
+    works for DEV_ID only
+    :param msg: incoming message update
+    """
+    queue = matchmaking.get_queue()
+    with queue.lock:
+        report = queue.histogram.report()
+
+    bot.send_message(
+        msg.from_user.id,
+        f'waiting: {len(queue)}\n{report}'
+    )
+
+
+@bot.message_handler(commands=['get_dispatcher'], func=lambda msg: msg.from_user.id in config.DEV_ID)
+def get_dispatcher(msg: telebot.types.Message):
+    """
+    Handles /get_dispatcher query - sends back queue depths and latencies of the dispatcher shards
+    works for DEV_ID only
+    :param msg: incoming message update
+    """
+    bot.send_message(
+        msg.from_user.id,
+        f'<pre>{update_dispatcher.report()}</pre>' if update_dispatcher else 'No dispatcher in this mode.',
+        parse_mode='HTML'
+    )
+
+
 @bot.message_handler(commands=['kick_user'], func=lambda msg: msg.from_user.id in config.DEV_ID)
 def kick_user(msg: telebot.types.Message):
     """
@@ -250,7 +311,9 @@ def kick_user(msg: telebot.types.Message):
     :param msg: incoming message update
     """
     user_id = int(msg.text.split()[1])
-    if User.delete().where(User.user_id == user_id).execute():
+    deleted = User.delete().where(User.user_id == user_id).execute()
+    utils.invalidate_user(user_id)
+    if deleted:
         bot.send_message(
             msg.from_user.id,
             'OK.'
@@ -294,15 +357,25 @@ def unknown(msg: telebot.types.Message):
         )
 
 
-@bot.callback_query_handler(func=lambda cb: utils.in_menu(cb.from_user) and not re.match("[0-9]-[0-9]", cb.data))
+@bot.callback_query_handler(func=lambda cb: utils.in_menu(cb.from_user) and not re.match("[0-9]-[0-9]", cb.data)
+                            and cb.data not in config.AI_LEVELS)
 def proceed_menu_button_click(cb: telebot.types.CallbackQuery):
     """
-    Handles any callback that doesn't match regex of field button click
+    Handles any callback that doesn't match regex of field button click or AI level
     coming from users with IN_MENU state
     :param cb: incoming callback update
     """
     logger.info(f'Got callback {cb.data} from id: {cb.from_user.id}.')
 
+    if cb.data == 'ai':
+        bot.edit_message_text(
+            'Choose AI level.',
+            cb.from_user.id,
+            cb.message.message_id,
+            reply_markup=buttons.get_ai_level_markup()
+        )
+        return
+
     message = bot.send_message(
         cb.from_user.id,
         'Starting the game.'
@@ -311,12 +384,7 @@ def proceed_menu_button_click(cb: telebot.types.CallbackQuery):
     if user:
         utils.update_dissolving_messages(user, 'starting_the_game', message)
 
-    if cb.data == 'ai':
-        # TODO inline keyboard for selecting AI difficulty level
-        logger.info(f'Starting AI game for id: {cb.from_user.id}.')
-        utils.start_new_game(bot, cb.from_user, 'ai')
-
-    elif cb.data == 'person':
+    if cb.data == 'person':
         logger.info(f'Starting PVP game for id: {cb.from_user.id}.')
         utils.start_new_game(bot, cb.from_user, 'person')
 
@@ -326,9 +394,31 @@ def proceed_menu_button_click(cb: telebot.types.CallbackQuery):
         cb.message.message_id
     )
 
-# TODO selecting difficulty level for AI-games
-# @bot.callback_query_handler(func=lambda cb: utils.in_menu(cb.from_user) and cb.data in ['s', 'm', 'h'])
-# def proceed_game_field_click(cb: telebot.types.CallbackQuery):
+
+@bot.callback_query_handler(func=lambda cb: utils.in_menu(cb.from_user) and cb.data in config.AI_LEVELS)
+def proceed_ai_level_click(cb: telebot.types.CallbackQuery):
+    """
+    Handles AI level buttons coming from users with IN_MENU state - starts AI game of that level
+    :param cb: incoming callback update
+    """
+    logger.info(f'Got callback {cb.data} from id: {cb.from_user.id}.')
+
+    message = bot.send_message(
+        cb.from_user.id,
+        'Starting the game.'
+    )
+    user = utils.get_user_or_none(cb.from_user)
+    if user:
+        utils.update_dissolving_messages(user, 'starting_the_game', message)
+
+    logger.info(f'Starting AI game of level {cb.data} for id: {cb.from_user.id}.')
+    utils.start_new_game(bot, cb.from_user, 'ai', cb.data)
+
+    logger.info(f'Deleting message {cb.message.text} from chat {cb.from_user.id}.')
+    bot.delete_message(
+        cb.from_user.id,
+        cb.message.message_id
+    )
 
 
 @bot.callback_query_handler(func=lambda cb: not utils.in_menu(cb.from_user) and re.match("[0-9]-[0-9]", cb.data))
@@ -341,6 +431,28 @@ def proceed_game_field_click(cb: telebot.types.CallbackQuery):
     utils.handle_game_field_click(bot, cb)
 
 
-# bot polling entry
+# bot entry
 if __name__ == '__main__':
-    bot.polling(none_stop=True)
+    # creating needed database tables and columns, a no-op when `python -m migrations` did it
+    migrations.migrate_database()
+    # calls of every mode go through the flood limits, restored AI moves are made right away
+    outbound.install()
+    utils.restore_matchmaking(bot)
+    utils.restore_ai_moves(bot)
+
+    if config.BOT_MODE == 'webhook':
+        update_dispatcher = ShardedDispatcher(bot)
+        webhook.run(bot, update_dispatcher)
+    elif config.BOT_MODE == 'polling':
+        update_dispatcher = ShardedDispatcher(bot)
+        # getUpdates is refused while a webhook of an earlier run is set
+        bot.remove_webhook()
+        update_dispatcher.poll()
+    elif config.BOT_MODE == 'async':
+        # needs aiohttp, which the other modes don't
+        import async_runtime
+
+        bot.remove_webhook()
+        async_runtime.AsyncRuntime(bot, limiter=outbound.get_limiter()).run()
+    else:
+        raise ValueError(f'Unknown BOT_MODE {config.BOT_MODE!r}, expected polling, webhook or async')
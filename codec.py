@@ -0,0 +1,38 @@
+"""
+Binary encoding of game fields kept in Game.field: 2 bits per cell, four cells per byte
+row by row from the top left cell, 11 bytes for a 6x7 field instead of ~100 characters of json.
+"""
+from typing import List
+
+from config import COLS, ROWS
+
+CELLS = ROWS * COLS
+FIELD_BYTES = (CELLS + 3) // 4
+
+# cells held by every byte value, the first cell in the lowest bits
+BYTE_CELLS = [(byte & 3, byte >> 2 & 3, byte >> 4 & 3, byte >> 6) for byte in range(256)]
+
+
+def encode_field(field: List[List[int]]) -> bytes:
+    """
+    :param field: matrix of game state with cells from 0 to 3
+    :return: encoded field
+    """
+    cells = [cell for row in field for cell in row] + [0] * (4 * FIELD_BYTES - CELLS)
+    return bytes(cells[i] | cells[i + 1] << 2 | cells[i + 2] << 4 | cells[i + 3] << 6 for i in range(0, len(cells), 4))
+
+
+def decode_field(data: bytes) -> List[List[int]]:
+    """
+    :param data: field encoded by encode_field, any bytes-like object
+    :return: matrix of game state
+    """
+    cells = [cell for byte in data for cell in BYTE_CELLS[byte]]
+    return [cells[row * COLS:(row + 1) * COLS] for row in range(ROWS)]
+
+
+def empty_field() -> bytes:
+    """
+    :return: encoded field of a new game
+    """
+    return bytes(FIELD_BYTES)
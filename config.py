@@ -1,12 +1,124 @@
 TOKEN = 'TOKEN'
 
+# how updates are received: 'polling' asks Telegram for them, 'webhook' has Telegram post them to
+# WEBHOOK_URL, which has to be HTTPS on port 443, 80, 88 or 8443, 'async' polls them in an asyncio loop
+# that also makes independent Telegram calls at once (needs aiohttp)
+BOT_MODE = 'polling'
+WEBHOOK_URL = 'https://example.com/tictacdrop'  # its path is the one served
+WEBHOOK_HOST = '0.0.0.0'  # address and port the server listens on, behind a proxy they may differ from the URL
+WEBHOOK_PORT = 8443
+WEBHOOK_SECRET = ''  # checked in every update, a random one is made for every run when empty
+WEBHOOK_CERT = ''  # paths of the certificate and its key when TLS is not terminated by a proxy
+WEBHOOK_KEY = ''
+WEBHOOK_SELF_SIGNED = False  # uploads WEBHOOK_CERT to Telegram
+WEBHOOK_MAX_CONNECTIONS = 40  # connections Telegram opens to deliver updates at once
+ASYNC_WORKERS = 8  # threads running handlers of different games at once, updates of a game go one by one
+ASYNC_QUEUE_SIZE = 256  # max updates handled or waiting, polling pauses until workers catch up
+ASYNC_POLL_TIMEOUT = 20  # seconds a getUpdates request waits for updates
+
+# polling and webhook modes handle updates on DISPATCH_SHARDS threads, updates of a game (or of a chat
+# when its user is not in a game) always go to the same one and are handled in order
+DISPATCH_SHARDS = 8
+DISPATCH_QUEUE_SIZE = 32  # updates waiting per shard, the webhook refuses more for Telegram to retry
+DISPATCH_LATENCY_WINDOW = 1000  # last handled updates shard latencies are reported over
+DISPATCH_POLL_TIMEOUT = 20  # seconds a getUpdates request waits for updates
+
+# flood limits of Telegram calls: calls a second after a burst, for all chats and for every chat.
+# Calls wait for their tokens in the thread making them, so in polling and webhook modes a chat over its
+# burst holds its dispatcher shard, and every game hashed to that shard, for 1 / OUTBOUND_CHAT_RATE
+# seconds a call; the asyncio mode waits in the event loop instead
+OUTBOUND_GLOBAL_RATE = 30
+OUTBOUND_GLOBAL_BURST = 30
+OUTBOUND_CHAT_RATE = 1
+OUTBOUND_CHAT_BURST = 4
+OUTBOUND_CHAT_BUCKETS = 10000  # idle chats are forgotten above it
+OUTBOUND_MAX_RETRIES = 3  # retries of a call answered with 429
+
+# HTTP client of Telegram calls, one pool of kept alive connections shared by all threads
+HTTP_POOL_SIZE = 16  # connections kept, threads wait for one when all are busy
+HTTP_CONNECT_TIMEOUT = 5  # seconds
+HTTP_READ_TIMEOUT = 30  # seconds, getUpdates waits longer by its long polling timeout
+HTTP_RETRIES = 2  # retries of calls that failed to connect, calls that may have been made are not retried
+HTTP_RETRY_BACKOFF = 0.5  # seconds before the first retry, doubled for every next one
+
 COLS = 7
 ROWS = 6
 
 HUMAN_PLAYER = 1
 AI_PLAYER = 2
 
-AI_DEPTH = 5
+AI_TIME_BUDGET = 0.15  # seconds of iterative deepening search per AI move at Hard level
+
+# processes computing AI moves
+AI_WORKERS = 2
+AI_QUEUE_SIZE = 16  # max jobs computed or waiting, more moves are refused; a root-parallel move takes AI_PARALLEL
+# AI moves whose making failed, on DB errors for example, are made again with a depth 1 move
+AI_MOVE_RETRIES = 3
+AI_MOVE_RETRY_DELAY = 5  # seconds
+
+# root-parallel search: root moves are split between AI_PARALLEL processes and searched deeper and deeper
+# up to AI_PARALLEL_DEPTH within the budget of the level instead of iterative deepening, 1 turns it off
+AI_PARALLEL = 1
+AI_PARALLEL_DEPTH = 8
+
+# endgame solver: positions with at most AI_SOLVER_EMPTY_CELLS empty cells are solved exactly,
+# unless it takes more than AI_SOLVER_BUDGET seconds, which are then taken from the budget of the search
+AI_SOLVER_EMPTY_CELLS = 16
+AI_SOLVER_BUDGET = 0.05
+AI_SOLVER_TT_SIZE = 1 << 18
+
+# opening book file made by `python -m book`, AI searches every move itself while there is none
+AI_BOOK_PATH = './book.bin'
+
+# AI difficulty levels picked with buttons.get_ai_level_markup, keyed by their callback data
+# budget - seconds of search per move, depth - max search depth (None for no limit),
+# noise - max random error added to evaluations of searched positions,
+# book & solver - whether the opening book and the endgame solver are used,
+# parallel - processes of root-parallel search of depth up to `depth` or AI_PARALLEL_DEPTH, 1 turns it off
+AI_LEVELS = {
+    's': {'budget': 0.01, 'depth': 2, 'noise': 1000, 'book': False, 'solver': False, 'parallel': 1},
+    'm': {'budget': 0.05, 'depth': 4, 'noise': 200, 'book': True, 'solver': False, 'parallel': 1},
+    'h': {'budget': AI_TIME_BUDGET, 'depth': None, 'noise': 0, 'book': True, 'solver': True, 'parallel': AI_PARALLEL},
+}
+AI_DEFAULT_LEVEL = 'h'  # level of games created before levels were introduced
+
+# transposition table of minimax search
+AI_TT_SIZE = 1 << 16  # max number of stored positions
+AI_TT_KEEP = False  # reuse table between moves of the same game
+AI_TT_GAMES = 16  # max number of games whose tables are kept by every worker, finished ones included
+
+# 'sqlite' for development or 'postgres' for a server shared through a pool of connections
+DB_BACKEND = 'sqlite'
+
+# SQLite database, every thread gets its own connection with these pragmas
+DB_PATH = './db.sqlite'
+DB_TIMEOUT = 5  # seconds a write waits for other connections to release the lock
+DB_PRAGMAS = {
+    # readers don't block the writer and the other way round
+    'journal_mode': 'wal',
+    # with WAL a crash can't corrupt the database, only a power loss may lose the last commits
+    'synchronous': 'normal',
+    'cache_size': -16 * 1024,  # negative is in KiB
+    'mmap_size': 64 * 1024 * 1024,
+    'temp_store': 'memory',
+}
+
+# PostgreSQL database, needs psycopg2
+DB_NAME = 'tictacdrop'
+DB_POSTGRES = {'user': 'tictacdrop', 'password': '', 'host': 'localhost', 'port': 5432}  # psycopg2.connect arguments
+DB_POOL_SIZE = 16  # max open connections, handler and AI callback threads hold one each while working
+DB_POOL_TIMEOUT = 10  # seconds to wait for a free connection when all of them are used
+DB_POOL_STALE_TIMEOUT = 300  # seconds after which an idle connection is reopened
+
+# seconds users and games looked up in DB are kept by utils, so handlers of one update
+# share the lookups; writes made through utils drop them at once
+DB_CACHE_TTL = 2.0
+
+# PVP matchmaking
+MATCHMAKING_TIMEOUT = 120  # seconds a player waits for an opponent before the search is cancelled
+MATCHMAKING_RATING_BUCKET = None  # width of wins - losses ranges players are paired within, None pairs anyone
+MATCHMAKING_SWEEP_INTERVAL = 1  # seconds between checks for timed out players
+MATCHMAKING_HISTOGRAM = (1, 5, 15, 30, 60, 120)  # upper bounds of wait time histogram bins, seconds
 
 # for special functionality
 DEV_ID = [662834330, 408970630, ]
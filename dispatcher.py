@@ -0,0 +1,183 @@
+"""
+Hands updates to a fixed set of worker threads, each with a queue of its own. Updates are hashed onto
+shards by the game of the user they come from, or by their chat when the user is not in a game, so both
+players' clicks on a board are handled one by one in order while different games run at once.
+"""
+import threading
+from collections import deque
+from queue import Full, Queue
+from time import monotonic, sleep
+from typing import Hashable, List, NamedTuple, Optional
+
+import telebot
+
+import config
+import logger
+import utils
+from models.base import connection
+
+# introducing a logger
+logger = logger.get_logger(__name__)
+
+
+def update_key(update: telebot.types.Update) -> Optional[Hashable]:
+    """
+    :return: game of the user update comes from, their chat when they are not in a game;
+    None for updates the bot doesn't handle
+    """
+    if update.message:
+        usr, chat_id = update.message.from_user, update.message.chat.id
+    elif update.callback_query:
+        # boards are sent to private chats of players
+        usr, chat_id = update.callback_query.from_user, update.callback_query.from_user.id
+    else:
+        return None
+
+    if usr:
+        try:
+            with connection():
+                user = utils.get_user_or_none(usr)
+                game = utils.get_users_game(user) if user else None
+        except Exception:
+            # a failed lookup must not stop polling or answering webhooks, the handler retries it
+            logger.exception(f'Looking up the game of update {update.update_id} failed, keying it by chat.')
+            game = None
+        if game:
+            return 'game', game.id
+    return 'chat', chat_id
+
+
+class ShardStats(NamedTuple):
+    depth: int  # updates waiting in the queue
+    peak: int  # most updates waited at once
+    handled: int
+    p50: float  # seconds from submitting an update to handling it, over the last handled ones
+    p99: float
+
+
+class Shard:
+    """
+    Queue of updates and the thread handling them in order
+    """
+
+    def __init__(self, index: int, queue_size: int):
+        self.index = index
+        self.queue = Queue(queue_size)
+        self.peak = 0
+        # guards handled and latencies, which are read while the thread of the shard adds to them
+        self.lock = threading.Lock()
+        self.handled = 0
+        self.latencies = deque(maxlen=config.DISPATCH_LATENCY_WINDOW)
+        self.thread: Optional[threading.Thread] = None
+
+    def stats(self) -> ShardStats:
+        with self.lock:
+            handled = self.handled
+            latencies = sorted(self.latencies)
+        return ShardStats(
+            self.queue.qsize(),
+            self.peak,
+            handled,
+            latencies[len(latencies) // 2] if latencies else 0.0,
+            latencies[int(len(latencies) * 0.99)] if latencies else 0.0
+        )
+
+
+class ShardedDispatcher:
+    """
+    Runs the handlers of bot for submitted updates on `shards` worker threads. Every shard queues at most
+    `queue_size` updates, submitting to a full one is refused or waits.
+    """
+
+    def __init__(self, bot: telebot.TeleBot, shards: int = config.DISPATCH_SHARDS,
+                 queue_size: int = config.DISPATCH_QUEUE_SIZE):
+        # shards run the handlers, so the bot must not queue them to its own threads again
+        bot.threaded = False
+        self.bot = bot
+        self.shards = [Shard(i, queue_size) for i in range(shards)]
+        self.stopped = threading.Event()
+        for shard in self.shards:
+            shard.thread = threading.Thread(
+                target=self._work, args=(shard,), name=f'dispatcher-shard-{shard.index}', daemon=True
+            )
+            shard.thread.start()
+
+    def shard(self, key: Optional[Hashable]) -> Shard:
+        return self.shards[hash(key) % len(self.shards)]
+
+    def submit(self, update: telebot.types.Update, block: bool = False) -> bool:
+        """
+        Queues update to the shard of its game or chat
+        :param block: waits for room in a full queue instead of refusing the update
+        :return: False if the queue is full and the update was not queued
+        """
+        shard = self.shard(update_key(update))
+        try:
+            shard.queue.put((monotonic(), update), block=block)
+        except Full:
+            logger.warning(f'Queue of shard {shard.index} is full, refusing update {update.update_id}.')
+            return False
+        shard.peak = max(shard.peak, shard.queue.qsize())
+        return True
+
+    def _work(self, shard: Shard) -> None:
+        while True:
+            item = shard.queue.get()
+            if item is None:
+                return
+            submitted, update = item
+            try:
+                self.bot.process_new_updates([update])
+            except Exception:
+                logger.exception(f'Handling update {update.update_id} failed.')
+            with shard.lock:
+                shard.latencies.append(monotonic() - submitted)
+                shard.handled += 1
+
+    def poll(self) -> None:
+        """
+        Gets updates from Telegram and submits them until stopped, waits for shards to catch up
+        """
+        offset = None
+        while not self.stopped.is_set():
+            try:
+                updates = self.bot.get_updates(
+                    offset=offset,
+                    timeout=config.DISPATCH_POLL_TIMEOUT,
+                    long_polling_timeout=config.DISPATCH_POLL_TIMEOUT,
+                    allowed_updates=['message', 'callback_query']
+                )
+            except Exception:
+                logger.exception('Getting updates failed.')
+                sleep(1)
+                continue
+
+            for update in updates:
+                if self.stopped.is_set():
+                    # not confirmed with an offset, Telegram delivers the rest to the next run
+                    return
+                self.submit(update, block=True)
+                offset = update.update_id + 1
+
+    def stop(self) -> None:
+        """
+        Stops polling and the shards once they handle updates already queued
+        """
+        self.stopped.set()
+        for shard in self.shards:
+            shard.queue.put(None)
+        for shard in self.shards:
+            shard.thread.join()
+
+    def stats(self) -> List[ShardStats]:
+        return [shard.stats() for shard in self.shards]
+
+    def report(self) -> str:
+        """
+        :return: text table of queue depths and latencies of the shards
+        """
+        lines = ['shard depth  peak  handled    p50ms    p99ms']
+        for index, stats in enumerate(self.stats()):
+            lines.append(f'{index:>5} {stats.depth:>5} {stats.peak:>5} {stats.handled:>8} '
+                         f'{stats.p50 * 1000:>8.1f} {stats.p99 * 1000:>8.1f}')
+        return '\n'.join(lines)
@@ -0,0 +1,80 @@
+from typing import List, Tuple
+
+from bitboard import Position, cell_bit
+from config import COLS, ROWS
+
+# (row delta, col delta) of lines scored by ai.utility_value: down, right, down-right, up-right
+LINE_DIRECTIONS = ((1, 0), (0, 1), (1, 1), (-1, 1))
+
+
+def line_segments(length: int) -> List[Tuple[int, ...]]:
+    """
+    :param length: number of cells in segment
+    :return: bits of cells of every straight segment of given length that fits on the board
+    """
+    segments = []
+    for dr, dc in LINE_DIRECTIONS:
+        for row in range(ROWS):
+            for col in range(COLS):
+                end_row = row + dr * (length - 1)
+                end_col = col + dc * (length - 1)
+                if 0 <= end_row < ROWS and 0 <= end_col < COLS:
+                    segments.append(tuple(cell_bit(row + dr * i, col + dc * i) for i in range(length)))
+    return segments
+
+
+# 69 windows of four cells, plus the shorter segments utility_value scores as twos and threes
+SEGMENTS = [segment for length in (2, 3, 4) for segment in line_segments(length)]
+
+
+def cell_segments(segments: List[Tuple[int, ...]]) -> List[List[Tuple[int, int]]]:
+    """
+    :return: (segment index, segment length) of every segment passing through each bit
+    """
+    result = [[] for _ in range(max(map(max, segments)) + 1)]
+    for index, segment in enumerate(segments):
+        for bit in segment:
+            result[bit].append((index, len(segment)))
+    return result
+
+
+CELL_SEGMENTS = cell_segments(SEGMENTS)
+
+
+class EvaluatedPosition(Position):
+    """
+    Position keeping the number of stones each player has in every segment, so sequence counts
+    are updated only for segments through the changed cell instead of rescanning the board
+    """
+
+    def __init__(self):
+        super().__init__()
+        # indexed by player number, 0 is unused
+        self.stones = [None, [0] * len(SEGMENTS), [0] * len(SEGMENTS)]
+        # segments completely filled by player, indexed by segment length
+        self.filled = [None, [0] * 5, [0] * 5]
+
+    def _set(self, bit: int, player: int) -> None:
+        super()._set(bit, player)
+        stones = self.stones[player]
+        filled = self.filled[player]
+        for index, length in CELL_SEGMENTS[bit]:
+            stones[index] += 1
+            if stones[index] == length:
+                filled[length] += 1
+
+    def _clear(self, bit: int, player: int) -> None:
+        super()._clear(bit, player)
+        stones = self.stones[player]
+        filled = self.filled[player]
+        for index, length in CELL_SEGMENTS[bit]:
+            if stones[index] == length:
+                filled[length] -= 1
+            stones[index] -= 1
+
+    def is_won(self, player: int) -> bool:
+        return self.filled[player][4] > 0
+
+    def sequence_counts(self, player: int) -> Tuple[int, int, int]:
+        filled = self.filled[player]
+        return filled[2], filled[3], filled[4]
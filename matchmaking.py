@@ -0,0 +1,177 @@
+"""
+In-process queue of PVP games waiting for a second player. Waiting games stay in DB as
+MATCHMAKING_GAME rows, the queue mirrors them so pairing is a dict operation under one lock
+instead of a lookup racing with other clicks.
+"""
+import bisect
+import threading
+from collections import OrderedDict
+from time import sleep, time
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence
+
+import config
+import logger
+
+# introducing a logger
+logger = logger.get_logger(__name__)
+
+
+class Waiting(NamedTuple):
+    game_id: int
+    bucket: int
+    since: float  # time.time() the player started waiting at
+    on_timeout: Callable[['Waiting'], None]  # called in the sweeper thread when nobody joins in time
+
+
+class WaitHistogram:
+    """
+    Counts how long players waited until they were paired or timed out
+    """
+
+    def __init__(self, bounds: Sequence[float] = config.MATCHMAKING_HISTOGRAM):
+        self.bounds = list(bounds)
+        # a bin for every bound and one for longer waits
+        self.paired = [0] * (len(self.bounds) + 1)
+        self.timeouts = 0
+        self.total = 0.0
+
+    def record(self, wait: float) -> None:
+        self.paired[bisect.bisect_left(self.bounds, wait)] += 1
+        self.total += wait
+
+    def report(self) -> str:
+        """
+        :return: text table of the histogram
+        """
+        count = sum(self.paired)
+        lines = [f'paired: {count}, timed out: {self.timeouts}, '
+                 f'mean wait: {self.total / count if count else 0:.1f}s']
+        lower = 0
+        for bound, paired in zip(self.bounds + [None], self.paired):
+            label = f'{lower:g}-{bound:g}s' if bound is not None else f'>{lower:g}s'
+            lines.append(f'{label:>10} {paired}')
+            lower = bound
+        return '\n'.join(lines)
+
+
+class MatchmakingQueue:
+    """
+    FIFO of waiting games per rating bucket. Players only meet opponents of their bucket,
+    one bucket holds everyone unless config.MATCHMAKING_RATING_BUCKET is set.
+    """
+
+    def __init__(self, timeout: float = config.MATCHMAKING_TIMEOUT,
+                 bucket_size: Optional[int] = config.MATCHMAKING_RATING_BUCKET,
+                 sweep_interval: float = config.MATCHMAKING_SWEEP_INTERVAL):
+        self.timeout = timeout
+        self.bucket_size = bucket_size
+        self.lock = threading.Lock()
+        # waiting games by id in order of waiting, per bucket
+        self.buckets: Dict[int, OrderedDict] = {}
+        # bucket of every waiting game, to remove left games without scanning
+        self.games: Dict[int, int] = {}
+        self.histogram = WaitHistogram()
+
+        self.sweeper = threading.Thread(
+            target=self._sweep, args=(sweep_interval,), name='matchmaking-sweeper', daemon=True
+        )
+        self.sweeper.start()
+
+    def bucket(self, rating: int) -> int:
+        """
+        :param rating: wins - losses of a player
+        :return: bucket the player is paired in
+        """
+        return rating // self.bucket_size if self.bucket_size else 0
+
+    def join(self, bucket: int, create_game: Callable[[], int],
+             on_timeout: Callable[[Waiting], None]) -> Optional[Waiting]:
+        """
+        Pairs a player with the longest waiting game of the bucket or queues a new game for them
+        :param bucket: bucket of the player
+        :param create_game: creates a waiting game in DB and returns its id; called under the lock,
+        so a concurrent join can't miss the game and create one more
+        :param on_timeout: called with the queued game when nobody joins it in time
+        :return: waiting game to join, None if a new one was queued
+        """
+        with self.lock:
+            games = self.buckets.get(bucket)
+            if games:
+                _, waiting = games.popitem(last=False)
+                del self.games[waiting.game_id]
+                self.histogram.record(time() - waiting.since)
+                return waiting
+
+            self._push(Waiting(create_game(), bucket, time(), on_timeout))
+            return None
+
+    def restore(self, waiting: Waiting) -> None:
+        """
+        Queues a game left waiting in DB by the previous run, games have to be restored oldest first
+        """
+        with self.lock:
+            self._push(waiting)
+
+    def _push(self, waiting: Waiting) -> None:
+        self.buckets.setdefault(waiting.bucket, OrderedDict())[waiting.game_id] = waiting
+        self.games[waiting.game_id] = waiting.bucket
+
+    def remove(self, game_id: int) -> bool:
+        """
+        Drops a game left before anyone joined it
+        :return: True if the game was waiting
+        """
+        with self.lock:
+            bucket = self.games.pop(game_id, None)
+            if bucket is None:
+                return False
+            del self.buckets[bucket][game_id]
+            return True
+
+    def expire(self) -> List[Waiting]:
+        """
+        Drops games waiting longer than the timeout, they are at the heads of their buckets
+        :return: dropped games
+        """
+        deadline = time() - self.timeout
+        expired = []
+        with self.lock:
+            for games in self.buckets.values():
+                while games:
+                    waiting = next(iter(games.values()))
+                    if waiting.since > deadline:
+                        break
+                    games.popitem(last=False)
+                    del self.games[waiting.game_id]
+                    expired.append(waiting)
+            self.histogram.timeouts += len(expired)
+        return expired
+
+    def _sweep(self, interval: float) -> None:
+        while True:
+            sleep(interval)
+            for waiting in self.expire():
+                try:
+                    waiting.on_timeout(waiting)
+                except Exception:
+                    logger.exception(f'Matchmaking timeout of game {waiting.game_id} failed.')
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.games)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue() -> MatchmakingQueue:
+    """
+    :return: matchmaking queue of the bot, created with the first request so the sweeper thread is
+    not started by merely importing the module
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = MatchmakingQueue()
+        return _queue
@@ -0,0 +1,87 @@
+"""
+Brings tables of databases created by older versions of the bot up to date with the models.
+Run from the repository root before starting the bot: python -m migrations
+"""
+import json
+from typing import List, Type
+
+from peewee import BlobField, Model
+from playhouse.migrate import SchemaMigrator, migrate
+
+import codec
+import logger
+from models.base import connection, db
+from models.game import Game
+from models.user import User
+
+MODELS = [User, Game]
+
+# introducing a logger
+logger = logger.get_logger(__name__)
+
+
+def add_missing_columns(model: Type[Model]) -> List[str]:
+    """
+    Adds columns of model fields its table does not have yet, filled with defaults of the fields
+    :param model: model whose table already exists
+    :return: names of added columns
+    """
+    table = model._meta.table_name
+    columns = {column.name for column in db.get_columns(table)}
+    migrator = SchemaMigrator.from_database(db)
+
+    added = []
+    for field in model._meta.sorted_fields:
+        if field.column_name not in columns:
+            logger.info(f'Adding column {field.column_name} to table {table}.')
+            migrate(migrator.add_column(table, field.column_name, field))
+            added.append(field.column_name)
+    return added
+
+
+def encode_fields() -> None:
+    """
+    Converts Game.field of games saved as json text to the binary encoding of codec
+    """
+    column = next(column for column in db.get_columns(Game._meta.table_name) if column.name == 'field')
+    if column.data_type.lower() not in ('blob', 'bytea'):
+        logger.info(f'Changing type of column field from {column.data_type} to binary.')
+        migrator = SchemaMigrator.from_database(db)
+        migrate(migrator.alter_column_type(Game._meta.table_name, 'field', BlobField()))
+
+    with db.atomic():
+        for game in Game.select(Game.id, Game.field):
+            # json rows come back as text, encoded ones as bytes
+            if isinstance(game.field, str):
+                field = codec.encode_field(json.loads(game.field))
+                Game.update(field=field).where(Game.id == game.id).execute()
+
+
+def count_moves() -> None:
+    """
+    Fills Game.moves of games started before moves were counted
+    """
+    with db.atomic():
+        for game in Game.select(Game.id, Game.field):
+            moves = sum(1 for row in codec.decode_field(game.field) for cell in row if cell)
+            Game.update(moves=moves).where(Game.id == game.id).execute()
+
+
+def migrate_database() -> None:
+    """
+    Creates missing tables and columns, converts data saved by older versions
+    """
+    with connection():
+        # also creates indexes declared by models that existing tables do not have
+        db.create_tables(MODELS)
+        added = {model: add_missing_columns(model) for model in MODELS}
+
+        # fields are read by the following migrations, so they are converted first
+        encode_fields()
+        if 'moves' in added[Game]:
+            count_moves()
+
+
+if __name__ == '__main__':
+    migrate_database()
+    logger.info('Database is up to date.')
@@ -1,6 +1,96 @@
+from contextlib import contextmanager
+
 from peewee import *
+from playhouse.pool import PooledDatabase, PooledPostgresqlDatabase
+
+import config
+
+
+class QueryCountingMixin:
+    """
+    Counts executed queries of a database, to see how many of them handling an update takes
+    """
+    queries = 0
+
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        self.queries += 1
+        return super().execute_sql(sql, params, *args, **kwargs)
+
+
+class CountingSqliteDatabase(QueryCountingMixin, SqliteDatabase):
+    pass
+
+
+class CountingPooledPostgresqlDatabase(QueryCountingMixin, PooledPostgresqlDatabase):
+    pass
+
+
+def create_database() -> Database:
+    """
+    :return: database of config.DB_BACKEND
+    """
+    if config.DB_BACKEND == 'sqlite':
+        return CountingSqliteDatabase(
+            config.DB_PATH,
+            pragmas=config.DB_PRAGMAS,
+            timeout=config.DB_TIMEOUT,
+            # a connection per thread, as handlers and AI callbacks run in thread pools
+            thread_safe=True
+        )
+
+    if config.DB_BACKEND == 'postgres':
+        # needs psycopg2, which is not installed for SQLite
+        return CountingPooledPostgresqlDatabase(
+            config.DB_NAME,
+            max_connections=config.DB_POOL_SIZE,
+            timeout=config.DB_POOL_TIMEOUT,
+            stale_timeout=config.DB_POOL_STALE_TIMEOUT,
+            **config.DB_POSTGRES
+        )
+
+    raise ValueError(f'Unknown DB_BACKEND {config.DB_BACKEND!r}, expected sqlite or postgres')
+
+
+db = create_database()
+
+
+def acquire_connection() -> bool:
+    """
+    Connects the current thread to the database unless it is connected already
+    :return: True if a connection was opened
+    """
+    return db.connect(reuse_if_open=True)
+
+
+def release_connection(opened: bool) -> None:
+    """
+    Returns a pooled connection opened by acquire_connection to the pool, SQLite connections stay
+    with their threads as reopening them costs more than keeping them
+    :param opened: result of acquire_connection
+    """
+    if opened and isinstance(db, PooledDatabase):
+        db.close()
+
+
+@contextmanager
+def connection():
+    """
+    Holds a connection of the current thread for a unit of work, like handling an update
+    """
+    opened = acquire_connection()
+    try:
+        yield
+    finally:
+        release_connection(opened)
+
+
+class BytesField(BlobField):
+    """
+    BlobField read as bytes from every backend, psycopg2 gives memoryview objects for bytea
+    """
 
-db = SqliteDatabase('./db.sqlite')
+    def python_value(self, value):
+        return bytes(value) if isinstance(value, memoryview) else value
 
 
 class BaseModel(Model):
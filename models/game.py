@@ -1,13 +1,16 @@
+from time import time
+
 from peewee import *
 
+import config
 from models import states
-from models.base import BaseModel
+from models.base import BaseModel, BytesField
 from models.user import User
 
 
 class Game(BaseModel):
-    user1 = ForeignKeyField(User)
-    user2 = ForeignKeyField(User, null=True)
+    user1 = ForeignKeyField(User, index=True)
+    user2 = ForeignKeyField(User, null=True, index=True)
     message1 = IntegerField(default=-1)
     message2 = IntegerField(default=-1)
 
@@ -15,4 +18,13 @@ class Game(BaseModel):
     state = IntegerField(default=states.NOT_CREATED_GAME)
     type = IntegerField()
 
-    field = CharField()  # json representation of matrix
+    field = BytesField()  # matrix encoded by codec.encode_field
+    moves = IntegerField(default=0)  # number of stones on field
+    difficulty = CharField(default=config.AI_DEFAULT_LEVEL)  # key of config.AI_LEVELS, AI games only
+    created = FloatField(default=time)  # time.time(), matchmaking wait starts with it
+
+    class Meta:
+        indexes = (
+            # waiting games are restored by state & type, state alone uses the same index
+            (('state', 'type'), False),
+        )
@@ -6,11 +6,11 @@ from models.base import BaseModel
 
 class User(BaseModel):
     first_name = CharField()
-    user_id = IntegerField(unique=True)
+    user_id = BigIntegerField(unique=True)  # telegram ids don't fit 32 bits
     state = IntegerField(default=states.USER_IN_MENU)
 
     wins = IntegerField(default=0)
     losses = IntegerField(default=0)
     draws = IntegerField(default=0)
 
-    dissolving_messages = CharField(default='{}')  # json
+    dissolving_messages = TextField(default='{}')  # json, longer than 255 characters with a few messages
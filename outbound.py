@@ -0,0 +1,292 @@
+"""
+Outbound layer of Telegram calls: keeps the bot under the flood limits with a global token bucket and one
+per chat, waits out 429 answers for their retry_after and drops edits of a message made stale by a newer
+edit of it queued behind them. Synchronous calls of telebot come through it as apihelper's request
+sender over one pool of kept alive connections, calls of the asyncio runtime use the limiter directly.
+"""
+import json
+import threading
+from time import monotonic, sleep
+from typing import Any, Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
+from urllib3.util.retry import Retry
+
+import config
+import logger
+
+# introducing a logger
+logger = logger.get_logger(__name__)
+
+# calls that are not about chats and are not limited
+UNLIMITED_METHODS = {'getUpdates', 'getMe', 'setWebhook', 'deleteWebhook', 'getWebhookInfo'}
+
+
+class TokenBucket:
+    """
+    Allows `rate` calls a second after a burst of `burst` calls. Calls reserve tokens in order and wait for
+    them, so tokens go negative while calls are waiting
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now: float) -> float:
+        """
+        Takes a token
+        :return: seconds to wait until it is there
+        """
+        self._refill(now)
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def pause(self, now: float, seconds: float) -> None:
+        """
+        Gives no tokens for seconds, after Telegram asked to retry later
+        """
+        self._refill(now)
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def refund(self, now: float) -> None:
+        """
+        Gives back a token taken by a call that was not made
+        """
+        self._refill(now)
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class RateLimiter:
+    """
+    Global and per chat token buckets, and the latest edits of messages for dropping stale ones
+    """
+
+    def __init__(self, rate: float = config.OUTBOUND_GLOBAL_RATE, burst: int = config.OUTBOUND_GLOBAL_BURST,
+                 chat_rate: float = config.OUTBOUND_CHAT_RATE, chat_burst: int = config.OUTBOUND_CHAT_BURST):
+        self.lock = threading.Lock()
+        self.bucket = TokenBucket(rate, burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chats: Dict[str, TokenBucket] = {}
+        # sequence numbers of the latest text edit and the latest edit of any kind of every message, kept
+        # while edits of the message are in flight so that older ones still waiting see they are stale
+        self.edits = 0
+        self.text_edits: Dict[Tuple[str, str], int] = {}
+        self.markup_edits: Dict[Tuple[str, str], int] = {}
+        self.pending_edits: Dict[Tuple[str, str], int] = {}
+        self.waited = 0.0
+        self.coalesced = 0
+        self.retries = 0
+
+    def _chat(self, chat_id: Any, now: float) -> TokenBucket:
+        # telebot sends ids of chats as ints or strings depending on the method
+        chat_id = str(chat_id)
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= config.OUTBOUND_CHAT_BUCKETS:
+                # full buckets are the same as new ones
+                self.chats = {chat: bucket for chat, bucket in self.chats.items() if not bucket.full(now)}
+            bucket = self.chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def reserve(self, chat_id: Optional[Any]) -> float:
+        """
+        Takes a token of the global bucket and one of the chat's bucket
+        :param chat_id: chat the call is made to, None for calls not made to a chat
+        :return: seconds to wait before making the call
+        """
+        with self.lock:
+            now = monotonic()
+            wait = self.bucket.reserve(now)
+            if chat_id is not None:
+                wait = max(wait, self._chat(chat_id, now).reserve(now))
+            self.waited += wait
+            return wait
+
+    def refund(self, chat_id: Optional[Any]) -> None:
+        """
+        Gives back the tokens reserve() took for a call that was not made
+        """
+        with self.lock:
+            now = monotonic()
+            self.bucket.refund(now)
+            if chat_id is not None:
+                self._chat(chat_id, now).refund(now)
+
+    def pause(self, chat_id: Optional[Any], seconds: float) -> None:
+        """
+        Holds calls to the chat, or all calls for None, after Telegram answered 429
+        """
+        with self.lock:
+            now = monotonic()
+            self.retries += 1
+            if chat_id is not None:
+                self._chat(chat_id, now).pause(now, seconds)
+            else:
+                self.bucket.pause(now, seconds)
+
+    def start_edit(self, method: str, chat_id: Any, message_id: Any) -> Tuple[str, Tuple[str, str], int]:
+        """
+        Registers an edit of a message, newer edits of it make the older ones stale
+        :param method: editMessageText, which replaces the text and the markup, or editMessageReplyMarkup
+        :return: ticket of the edit for superseded() and finish_edit()
+        """
+        key = str(chat_id), str(message_id)
+        with self.lock:
+            self.edits += 1
+            if method == 'editMessageText':
+                self.text_edits[key] = self.edits
+            self.markup_edits[key] = self.edits
+            self.pending_edits[key] = self.pending_edits.get(key, 0) + 1
+            return method, key, self.edits
+
+    def superseded(self, ticket: Tuple[str, Tuple[str, str], int]) -> bool:
+        """
+        :return: whether a newer edit of the message replaces everything the edit of ticket changes
+        """
+        method, key, edit = ticket
+        with self.lock:
+            latest = self.text_edits if method == 'editMessageText' else self.markup_edits
+            # registered by start_edit() for this or a newer edit and kept until they are all finished
+            if latest[key] > edit:
+                self.coalesced += 1
+                return True
+            return False
+
+    def finish_edit(self, ticket: Tuple[str, Tuple[str, str], int]) -> None:
+        """
+        Forgets the edits of the message once none of them is in flight
+        """
+        _, key, _ = ticket
+        with self.lock:
+            self.pending_edits[key] -= 1
+            if not self.pending_edits[key]:
+                del self.pending_edits[key]
+                self.text_edits.pop(key, None)
+                self.markup_edits.pop(key, None)
+
+    def report(self) -> str:
+        with self.lock:
+            return (f'waited: {self.waited:.1f}s, stale edits dropped: {self.coalesced}, '
+                    f'429 retries: {self.retries}, chats: {len(self.chats)}')
+
+
+def retry_after(result_json: dict) -> Optional[float]:
+    """
+    :return: seconds Telegram asked to wait with a 429 answer, None for other answers
+    """
+    if result_json.get('error_code') != 429:
+        return None
+    return result_json.get('parameters', {}).get('retry_after', 1)
+
+
+def create_session(pool_size: int = config.HTTP_POOL_SIZE, retries: int = config.HTTP_RETRIES,
+                   backoff: float = config.HTTP_RETRY_BACKOFF) -> requests.Session:
+    """
+    :return: session keeping up to pool_size connections alive for all threads, unlike telebot's session
+    per thread, which opens (and handshakes) connections again for every new thread and every 10 minutes
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1,  # Telegram is the only host
+        pool_maxsize=pool_size,
+        # a call answered with anything, even 5xx, may have been made, so only failed connections are retried
+        max_retries=Retry(total=retries, connect=retries, read=0, status=0, other=0,
+                          backoff_factor=backoff, allowed_methods=None, raise_on_status=False),
+        pool_block=True
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class OutboundSender:
+    """
+    Request sender of apihelper making the calls of telebot through the limiter and a shared session
+    """
+
+    def __init__(self, limiter: RateLimiter, session: Optional[requests.Session] = None):
+        self.limiter = limiter
+        self.session = session or create_session()
+
+    def __call__(self, method: str, url: str, params: Optional[dict] = None, files: Optional[dict] = None,
+                 timeout: Optional[Tuple[float, float]] = None, proxies: Optional[dict] = None) -> requests.Response:
+        name = url.rsplit('/', 1)[-1]
+        if name in UNLIMITED_METHODS:
+            return self.session.request(method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+
+        chat_id = params.get('chat_id') if params else None
+        ticket = None
+        if name in ('editMessageText', 'editMessageReplyMarkup') and params.get('message_id'):
+            ticket = self.limiter.start_edit(name, chat_id, params['message_id'])
+        try:
+            for attempt in range(config.OUTBOUND_MAX_RETRIES + 1):
+                if ticket and self.limiter.superseded(ticket):
+                    logger.debug(f'Dropping {name} of message {params["message_id"]} in favor of a newer one.')
+                    return done()
+                # blocks the calling thread, a dispatcher shard stalls every game hashed to it meanwhile
+                sleep(self.limiter.reserve(chat_id))
+                if ticket and self.limiter.superseded(ticket):
+                    # made stale while waiting, the newer edit gets the tokens
+                    self.limiter.refund(chat_id)
+                    logger.debug(f'Dropping {name} of message {params["message_id"]} in favor of a newer one.')
+                    return done()
+
+                response = self.session.request(
+                    method, url, params=params, files=files, timeout=timeout, proxies=proxies
+                )
+                if response.status_code != 429 or attempt == config.OUTBOUND_MAX_RETRIES:
+                    return response
+
+                seconds = retry_after(response.json())
+                logger.warning(f'{name} to chat {chat_id} hit the flood limit, retrying in {seconds}s.')
+                self.limiter.pause(chat_id, seconds)
+        finally:
+            if ticket:
+                self.limiter.finish_edit(ticket)
+
+
+def done() -> requests.Response:
+    """
+    :return: successful answer of an edit, for edits that are not made
+    """
+    response = requests.Response()
+    response.status_code = 200
+    response._content = json.dumps({'ok': True, 'result': True}).encode()
+    return response
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter() -> RateLimiter:
+    """
+    :return: limiter shared by all calls of the bot
+    """
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+        return _limiter
+
+
+def install() -> None:
+    """
+    Makes telebot send its calls through the limiter and the shared session
+    """
+    apihelper.CONNECT_TIMEOUT = config.HTTP_CONNECT_TIMEOUT
+    apihelper.READ_TIMEOUT = config.HTTP_READ_TIMEOUT
+    apihelper.CUSTOM_REQUEST_SENDER = OutboundSender(get_limiter())
@@ -0,0 +1,220 @@
+"""
+Perfect-play solver for endgames: negamax with alpha-beta on bitboards and null-window
+searches narrowing the score. Score of a position is positive when the side to move wins,
+negative when it loses and 0 for a draw; the sooner the game is won, the bigger the score.
+"""
+from time import monotonic
+from typing import List, NamedTuple, Optional, Tuple
+
+import config
+from bitboard import BOTTOM_MASK, DIAGONAL_DOWN, DIAGONAL_UP, HEIGHT, HORIZONTAL, Position, popcount
+from config import COLS, ROWS
+from transposition import UPPER, TranspositionTable
+
+CELLS = ROWS * COLS
+BOARD_MASK = BOTTOM_MASK * ((1 << ROWS) - 1)
+
+# columns closer to the center are tried first
+COLUMN_ORDER = sorted(range(COLS), key=lambda col: abs(COLS // 2 - col))
+COLUMN_MASKS = [((1 << ROWS) - 1) << (col * HEIGHT) for col in range(COLS)]
+
+# how many nodes are solved between two checks of the clock
+TIME_CHECK_NODES = 64
+
+WIN = 1
+DRAW = 0
+LOSS = -1
+
+
+class SolverTimeout(Exception):
+    """
+    Raised inside the solver when its deadline has passed
+    """
+
+
+class Outcome(NamedTuple):
+    result: int  # WIN, DRAW or LOSS for the side to move
+    plies: int  # moves of both sides until the game ends, counting the last one
+
+
+def winning_cells(stones: int, mask: int) -> int:
+    """
+    :param stones: bitboard of player's stones
+    :param mask: bitboard of all stones
+    :return: empty cells that would complete a four of player
+    """
+    # vertical: three stones right below the cell
+    cells = (stones << 1) & (stones << 2) & (stones << 3)
+
+    for step in (HORIZONTAL, DIAGONAL_DOWN, DIAGONAL_UP):
+        pairs = (stones << step) & (stones << 2 * step)
+        cells |= pairs & (stones << 3 * step)
+        cells |= pairs & (stones >> step)
+        pairs = (stones >> step) & (stones >> 2 * step)
+        cells |= pairs & (stones << step)
+        cells |= pairs & (stones >> 3 * step)
+
+    return cells & (BOARD_MASK ^ mask)
+
+
+def outcome_of(score: int, moves: int) -> Outcome:
+    """
+    :param score: score of position
+    :param moves: number of stones in position
+    :return: result and length of the rest of the game under perfect play
+    """
+    if score == 0:
+        return Outcome(DRAW, CELLS - moves)
+
+    # the winner drops the last stone to a board of `last` stones, where score = (CELLS + 1 - last) // 2
+    winner_parity = moves % 2 if score > 0 else 1 - moves % 2
+    last = CELLS + 1 - 2 * abs(score)
+    if last % 2 != winner_parity:
+        last -= 1
+    return Outcome(WIN if score > 0 else LOSS, last - moves + 1)
+
+
+class Solver:
+    """
+    Solves positions exactly. Upper bounds of searched positions are kept in a transposition
+    table between calls, so solving several positions of one game is cheaper than the first one.
+    Solving raises SolverTimeout once monotonic() passes `deadline`, when one is given.
+    """
+
+    def __init__(self, table_size: int = config.AI_SOLVER_TT_SIZE, deadline: Optional[float] = None):
+        self.table = TranspositionTable(table_size)
+        self.deadline = deadline
+        self.nodes = 0
+
+    def restart(self, deadline: Optional[float] = None) -> None:
+        """
+        Starts solving another position until deadline; bounds stored for earlier ones are still used,
+        but may be replaced by the new ones
+        """
+        self.table.new_search()
+        self.deadline = deadline
+        self.nodes = 0
+
+    def solve(self, position: Position, player: int) -> int:
+        """
+        :param position: position with player to move and without a four
+        :param player: player to move
+        :return: score of position
+        """
+        return self._solve(position.boards[player], position.mask, position.count)
+
+    def best_move(self, position: Position, player: int) -> Tuple[int, Outcome]:
+        """
+        :param position: position with player to move and without a four
+        :param player: player to move
+        :return: the move that ends the game best for player (soonest win, latest loss) & the outcome
+        """
+        stones, mask, moves = position.boards[player], position.mask, position.count
+
+        best_move, best_score = None, None
+        for col in self.playable(mask):
+            move = (mask + (1 << col * HEIGHT)) & COLUMN_MASKS[col]
+            if winning_cells(stones, mask) & move:
+                score = (CELLS + 1 - moves) // 2
+            elif moves + 1 == CELLS:
+                score = 0
+            else:
+                score = -self._solve(stones ^ mask, mask | move, moves + 1)
+
+            if best_score is None or score > best_score:
+                best_move, best_score = col, score
+
+        return best_move, outcome_of(best_score, moves)
+
+    @staticmethod
+    def playable(mask: int) -> List[int]:
+        """
+        :return: columns with empty cells, central ones first
+        """
+        return [col for col in COLUMN_ORDER if not mask & (1 << (col * HEIGHT + ROWS - 1))]
+
+    def _solve(self, stones: int, mask: int, moves: int) -> int:
+        possible = (mask + BOTTOM_MASK) & BOARD_MASK
+        if winning_cells(stones, mask) & possible:
+            return (CELLS + 1 - moves) // 2
+
+        # narrow [low, high] with null-window searches, probing around 0 first
+        # as wins and losses are decided faster than exact scores
+        low = -((CELLS - moves) // 2)
+        high = (CELLS + 1 - moves) // 2
+        while low < high:
+            middle = low + (high - low) // 2
+            if middle <= 0 and int(low / 2) < middle:
+                middle = int(low / 2)
+            elif middle >= 0 and int(high / 2) > middle:
+                middle = int(high / 2)
+
+            score = self._negamax(stones, mask, moves, middle, middle + 1)
+            if score <= middle:
+                high = score
+            else:
+                low = score
+        return low
+
+    def _negamax(self, stones: int, mask: int, moves: int, alpha: int, beta: int) -> int:
+        """
+        Alpha-beta search of a position where the side to move can not win at once
+        :param stones: bitboard of stones of the side to move
+        :param mask: bitboard of all stones
+        :param moves: number of stones
+        """
+        self.nodes += 1
+        if self.deadline is not None and self.nodes % TIME_CHECK_NODES == 0 and monotonic() > self.deadline:
+            raise SolverTimeout()
+
+        possible = (mask + BOTTOM_MASK) & BOARD_MASK
+        opponent_wins = winning_cells(stones ^ mask, mask)
+        forced = possible & opponent_wins
+        if forced:
+            if forced & (forced - 1):
+                # two threats at once can not be blocked
+                return -((CELLS - moves) // 2)
+            possible = forced
+        # never play right below a cell where the opponent completes a four
+        possible &= ~(opponent_wins >> 1)
+        if not possible:
+            return -((CELLS - moves) // 2)
+
+        if moves >= CELLS - 2:
+            return 0
+
+        # the opponent can not win with the next move, so the loss is at least two moves away
+        low = -((CELLS - 2 - moves) // 2)
+        if alpha < low:
+            alpha = low
+            if alpha >= beta:
+                return alpha
+
+        # nor can the side to move win now, as it would have been found before
+        high = (CELLS - 1 - moves) // 2
+        key = stones + mask
+        entry = self.table.probe(key)
+        if entry is not None:
+            high = entry.value
+        if beta > high:
+            beta = high
+            if alpha >= beta:
+                return beta
+
+        # moves creating more winning cells first
+        candidates = []
+        for col in COLUMN_ORDER:
+            move = possible & COLUMN_MASKS[col]
+            if move:
+                candidates.append((popcount(winning_cells(stones | move, mask | move)), move))
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+
+        for _, move in candidates:
+            score = -self._negamax(stones ^ mask, mask | move, moves + 1, -beta, -alpha)
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+
+        self.table.store(key, CELLS - moves, UPPER, alpha, None)
+        return alpha
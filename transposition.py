@@ -0,0 +1,104 @@
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+import config
+
+# kinds of values stored in the table
+EXACT = 0
+LOWER = 1  # real value is at least the stored one
+UPPER = 2  # real value is at most the stored one
+
+
+class Entry(NamedTuple):
+    key: int
+    depth: int
+    bound: int
+    value: float
+    move: Optional[int]
+    generation: int
+
+
+class TranspositionTable:
+    """
+    Fixed-size table of searched positions indexed by Zobrist key. An entry is replaced by
+    a deeper (or equally deep) search of any position, or by anything once it is left from
+    a previous search, so memory never grows past `size` entries.
+    """
+
+    def __init__(self, size: int = config.AI_TT_SIZE):
+        self.size = size
+        self.slots = [None] * size
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def new_search(self) -> None:
+        """
+        Marks entries of all previous searches as replaceable
+        """
+        self.generation += 1
+
+    def probe(self, key: int) -> Optional[Entry]:
+        """
+        :param key: Zobrist key of position
+        :return: stored entry for the position, None if it was not stored
+        """
+        entry = self.slots[key % self.size]
+        if entry is not None and entry.key == key:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        return None
+
+    def store(self, key: int, depth: int, bound: int, value: float, move: Optional[int]) -> None:
+        """
+        Saves search result of a position if it is worth more than the one in its slot
+        :param key: Zobrist key of position
+        :param depth: remaining depth the position was searched to
+        :param bound: EXACT, LOWER or UPPER
+        :param value: value found by the search
+        :param move: best move found, None if no move raised the bound
+        """
+        index = key % self.size
+        old = self.slots[index]
+        if old is None or old.key == key or old.generation != self.generation or old.depth <= depth:
+            self.slots[index] = Entry(key, depth, bound, value, move, self.generation)
+            self.stores += 1
+
+    def stats(self) -> dict:
+        probes = self.hits + self.misses
+        return {
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'hit_rate': self.hits / probes if probes else 0,
+        }
+
+
+# tables kept between moves of the same game in a worker process, least recently used ones are dropped first;
+# the bot process doesn't know which worker holds the table of a game, so tables of finished games are
+# only dropped by this bound and games of reused ids start with a new table on their first AI move
+_game_tables = OrderedDict()
+
+
+def get_game_table(game_id: int, level: str, first_move: bool) -> TranspositionTable:
+    """
+    :param game_id: id of AI game
+    :param level: AI level of the game, tables of different levels are kept apart
+    :param first_move: whether the table is for the first AI move of the game, which gets a new one
+    :return: table of given game, a new one for unknown games
+    """
+    key = game_id, level
+    table = _game_tables.pop(key, None)
+    if table is None or first_move:
+        table = TranspositionTable()
+    _game_tables[key] = table
+
+    while len(_game_tables) > config.AI_TT_GAMES:
+        _game_tables.popitem(last=False)
+
+    return table
@@ -1,65 +1,253 @@
 import json
-from typing import List, Optional, Tuple, Any
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from functools import partial
+from time import monotonic
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Type
 
 import jsonpickle
 import telebot
-from peewee import ModelSelect
+from peewee import JOIN, Field, Model, ModelSelect
 
 import buttons
+import codec
 import config
 import logger
 from models import states
+from models.base import connection, db
 from models.game import Game
 from models.user import User
 
 import ai
+import ai_service
+import matchmaking
 
 # introducing a logger
 logger = logger.get_logger(__name__)
 
+# rows of users by telegram id and rows of users' games by User.id, with their expiry times
+_user_cache = {}
+_game_cache = {}
+# telegram id of every cached user by User.id, to attach players to games without lookups
+_user_ids = {}
+_cache_lock = threading.Lock()
+# bumped by every invalidation, rows read before it are not cached as they may be outdated
+_cache_generation = 0
+# invalidations made by the running transaction of a thread, repeated when it ends
+_transaction = threading.local()
+# makes batches of independent Telegram calls, set by the asyncio runtime to make them at once
+_call_runner: Optional[Callable[[Sequence[partial]], List[Any]]] = None
+
+
+def set_call_runner(runner: Optional[Callable[[Sequence[partial]], List[Any]]]) -> None:
+    """
+    :param runner: makes the calls given to concurrently() and returns their results, None makes them one by one
+    """
+    global _call_runner
+    _call_runner = runner
+
+
+def concurrently(*calls: partial) -> List[Any]:
+    """
+    Makes Telegram calls that don't depend on each other. The asyncio runtime makes them at once, keeping
+    the order of calls to the same chat; otherwise they are made one by one
+    :param calls: partials of bot methods, e.g. partial(bot.send_message, chat_id, text)
+    :return: results of the calls in their order
+    """
+    if _call_runner:
+        return _call_runner(calls)
+    return [call() for call in calls]
+
+
+def _cache_get(cache: Dict[int, Tuple[float, Optional[dict]]], key: int) -> Tuple[bool, Optional[dict]]:
+    """
+    :return: whether key is cached & its row (None for a cached absence)
+    """
+    with _cache_lock:
+        entry = cache.get(key)
+        if entry is None or entry[0] < monotonic():
+            return False, None
+        return True, entry[1]
+
+
+def _cache_put(cache: Dict[int, Tuple[float, Optional[dict]]], key: int, row: Optional[dict], generation: int) -> None:
+    """
+    Caches row read from DB when nothing was invalidated since generation
+    """
+    with _cache_lock:
+        if generation == _cache_generation:
+            cache[key] = (monotonic() + config.DB_CACHE_TTL, row)
+
+
+def _from_row(model: Type[Model], row: Optional[dict]) -> Optional[Model]:
+    """
+    :return: a new instance of model for a cached row, so callers never share changes
+    """
+    if row is None:
+        return None
+    instance = model(__no_default__=True)
+    instance.__data__ = dict(row)
+    return instance
+
+
+def invalidate_user(user_id: int) -> None:
+    """
+    Drops cached user
+    :param user_id: telegram id of the user
+    """
+    global _cache_generation
+    with _cache_lock:
+        _cache_generation += 1
+        _user_cache.pop(user_id, None)
+    _defer(invalidate_user, user_id)
+
+
+def invalidate_games(*user_ids: Optional[int]) -> None:
+    """
+    Drops cached games of users
+    :param user_ids: User.id of users, None is skipped
+    """
+    global _cache_generation
+    with _cache_lock:
+        _cache_generation += 1
+        for user_id in user_ids:
+            _game_cache.pop(user_id, None)
+    _defer(invalidate_games, *user_ids)
+
 
-def update_game(game: Game) -> bool:
+def invalidate_game(game: Game) -> None:
     """
-    Updates game record in DB
+    Drops cached game of both its players
+    """
+    invalidate_games(game.__data__.get('user1'), game.__data__.get('user2'))
+
+
+def _defer(invalidate, *args) -> None:
+    """
+    Remembers an invalidation made inside atomic() to make it again after the transaction
+    """
+    pending = getattr(_transaction, 'pending', None)
+    if pending is not None:
+        pending.append((invalidate, args))
+
+
+@contextmanager
+def atomic():
+    """
+    Makes DB writes of the block in one transaction. Other threads keep reading old rows until it is
+    committed and may cache them meanwhile, so cache entries invalidated inside are dropped again after it
+    """
+    outer = getattr(_transaction, 'pending', None) is None
+    if outer:
+        _transaction.pending = []
+    try:
+        with db.atomic():
+            yield
+    finally:
+        if outer:
+            pending, _transaction.pending = _transaction.pending, None
+            for invalidate, args in pending:
+                invalidate(*args)
+
+
+def clear_cache() -> None:
+    """
+    Drops all cached users and games
+    """
+    global _cache_generation
+    with _cache_lock:
+        _cache_generation += 1
+        _user_cache.clear()
+        _game_cache.clear()
+        _user_ids.clear()
+
+
+def _get_user(user_id: int) -> Optional[User]:
+    """
+    :param user_id: telegram id of the user
+    :return: User object, None if not found
+    """
+    cached, row = _cache_get(_user_cache, user_id)
+    if not cached:
+        generation = _cache_generation
+        user = User.get_or_none(User.user_id == user_id)
+        if not user:
+            _cache_put(_user_cache, user_id, None, generation)
+            return None
+        _remember_user(user, generation)
+        row = user.__data__
+
+    return _from_row(User, row)
+
+
+def _remember_user(user: User, generation: int) -> None:
+    """
+    Caches user read from DB
+    """
+    _cache_put(_user_cache, user.user_id, user.__data__, generation)
+    with _cache_lock:
+        _user_ids[user.id] = user.user_id
+
+
+def _attach_players(game: Game) -> Game:
+    """
+    Sets game.user1 & game.user2 to cached users, so reading them makes no lookups
+    """
+    for name in ('user1', 'user2'):
+        pk = game.__data__.get(name)
+        with _cache_lock:
+            user_id = _user_ids.get(pk)
+        if user_id is None:
+            continue
+        user = _get_user(user_id)
+        if user and user.id == pk:
+            game.__rel__[name] = user
+    return game
+
+
+def _changes(instance: Model) -> Dict[Field, Any]:
+    """
+    :return: values of fields set since instance was read or written, which are then no longer dirty
+    """
+    changes = {field: instance.__data__[field.name] for field in instance.dirty_fields}
+    instance._dirty.clear()
+    return changes
+
+
+def update_game(game: Game, turn: Optional[Tuple[int, int]] = None) -> bool:
+    """
+    Updates changed fields of game record in DB
     :param game: game that needs to be updated in DB
+    :param turn: (move, moves) of game before the change; when given, the record is only updated if it
+    still has them, so of concurrent clicks on the same turn only the first one moves
     :return: True if any of DB records were modified, else False
     """
-    q = (game.update(
-        {
-            Game.user1: game.user1,
-            Game.user2: game.user2,
-            Game.message1: game.message1,
-            Game.message2: game.message2,
-            Game.move: game.move,
-            Game.state: game.state,
-            Game.type: game.type,
-            Game.field: game.field,
-        }
-    ).where(
-        Game.id == game.id
-    ))
+    changes = _changes(game)
+    if not changes:
+        return False
+
+    q = Game.update(changes).where(Game.id == game.id)
+    if turn:
+        q = q.where((Game.move == turn[0]) & (Game.moves == turn[1]))
     updated = q.execute()
+    invalidate_game(game)
 
     return bool(updated)
 
 
 def update_user(user: User) -> bool:
     """
-    Updates user record in DB
+    Updates changed fields of user record in DB
     :param user: user that needs to be updated in DB
     :return: True if any of DB records were modified, else False
     """
-    updated = User.update(
-        {
-            User.state: user.state,
-            User.wins: user.wins,
-            User.losses: user.losses,
-            User.draws: user.draws,
-            User.dissolving_messages: user.dissolving_messages
-        }
-    ).where(
-        User.id == user.id
-    ).execute()
+    changes = _changes(user)
+    if not changes:
+        return False
+
+    updated = User.update(changes).where(User.id == user.id).execute()
+    invalidate_user(user.user_id)
 
     return bool(updated)
 
@@ -70,7 +258,7 @@ def exists_user(usr: telebot.types.User) -> bool:
     :param usr: telebot.types.User object representing telegram user
     :return: True if user record is in DB, False otherwise
     """
-    return bool(User.get_or_none(User.user_id == usr.id))
+    return bool(_get_user(usr.id))
 
 
 def save_user(usr: telebot.types.User) -> bool:
@@ -85,6 +273,7 @@ def save_user(usr: telebot.types.User) -> bool:
             user_id=usr.id,
             first_name=usr.first_name,
         ).execute()
+        invalidate_user(usr.id)
         return True
     else:
         logger.info(f'User id: {usr.id} is in DB.')
@@ -97,7 +286,7 @@ def in_pvp_game(usr: telebot.types.User) -> bool:
     :param usr: telebot.types.User object representing telegram user
     :return: True if usr is in PVP game, False otherwise
     """
-    user = User.get_or_none(User.user_id == usr.id)
+    user = _get_user(usr.id)
     if not user:
         return False
 
@@ -110,7 +299,7 @@ def in_ai_game(usr: telebot.types.User) -> bool:
     :param usr: telebot.types.User object representing telegram user
     :return: True if usr is in AI game, False otherwise
     """
-    user = User.get_or_none(User.user_id == usr.id)
+    user = _get_user(usr.id)
     if not user:
         return False
 
@@ -123,7 +312,7 @@ def in_menu(usr: telebot.types.User) -> bool:
     :param usr: telebot.types.User object representing telegram user
     :return: True if usr is in menu, False otherwise
     """
-    user = User.get_or_none(User.user_id == usr.id)
+    user = _get_user(usr.id)
     if not user:
         return False
 
@@ -142,7 +331,7 @@ def get_user_or_none(usr: telebot.types.User) -> Optional[User]:
     :param usr: telebot.types.User object representing telegram user
     :return: User object corresponding to given user_id, None if not found
     """
-    return User.get_or_none(User.user_id == usr.id)
+    return _get_user(usr.id)
 
 
 def get_users_game(user: User) -> Optional[Game]:
@@ -151,7 +340,56 @@ def get_users_game(user: User) -> Optional[Game]:
     :param user: User object, whose game is being retrieved
     :return: user's game (or None)
     """
-    return Game.get_or_none(Game.user1 == user) or Game.get_or_none(Game.user2 == user)
+    cached, row = _cache_get(_game_cache, user.id)
+    if not cached:
+        generation = _cache_generation
+        game = _select_users_game(user)
+        row = game.__data__ if game else None
+        _cache_put(_game_cache, user.id, row, generation)
+
+        # players came with the game, so attaching them makes no lookups
+        for player in (game.user1, game.user2) if game else ():
+            if player:
+                _remember_user(player, generation)
+
+    game = _from_row(Game, row)
+    return _attach_players(game) if game else None
+
+
+def _select_users_game(user: User) -> Optional[Game]:
+    """
+    :return: game user plays in either role with both players, in a single query
+    """
+    user1 = User.alias()
+    user2 = User.alias()
+    return (Game
+            .select(Game, user1, user2)
+            .join(user1, on=(Game.user1 == user1.id))
+            .switch(Game)
+            .join(user2, JOIN.LEFT_OUTER, on=(Game.user2 == user2.id))
+            .where((Game.user1 == user) | (Game.user2 == user))
+            .get_or_none())
+
+
+def get_game(game_id: int) -> Optional[Game]:
+    """
+    Reads game from DB bypassing the cache
+    :param game_id: id of the game
+    :return: game with its players attached from the cache (or None)
+    """
+    game = Game.get_or_none(Game.id == game_id)
+    return _attach_players(game) if game else None
+
+
+def delete_game(game: Game) -> None:
+    """
+    Deletes finished or left game with everything kept for it
+    :param game: game to delete
+    """
+    if game.state == states.MATCHMAKING_GAME:
+        matchmaking.get_queue().remove(game.id)
+    Game.delete_by_id(game.id)
+    invalidate_game(game)
 
 
 def get_game_user_opponent(usr: telebot.types.User) -> Tuple[Optional[Game], Optional[User], Optional[User]]:
@@ -163,7 +401,7 @@ def get_game_user_opponent(usr: telebot.types.User) -> Tuple[Optional[Game], Opt
     user = get_user_or_none(usr)
     if not user:
         return None, None, None
-    game = Game.get_or_none(Game.user1 == user) or Game.get_or_none(Game.user2 == user)
+    game = get_users_game(user)
     if not game:
         return None, None, None
     opponent = game.user1 if game.user2 == user else game.user2
@@ -171,15 +409,16 @@ def get_game_user_opponent(usr: telebot.types.User) -> Tuple[Optional[Game], Opt
     return game, user, opponent
 
 
-def handle_ai_game(bot: telebot.TeleBot, user: User) -> None:
+def handle_ai_game(bot: telebot.TeleBot, user: User, level: str) -> None:
     """
     :param bot:
     :param user:
+    :param level: key of config.AI_LEVELS
     """
     logger.info(f'Setting state of id: {user.user_id} to IN_AI_GAME.')
     user.state = states.USER_IN_AI_GAME
     update_user(user)
-    new_ai_game(bot, user)
+    new_ai_game(bot, user, level)
 
 
 def handle_pvp_game(bot: telebot.TeleBot, user: User) -> None:
@@ -197,21 +436,19 @@ def handle_pvp_game(bot: telebot.TeleBot, user: User) -> None:
     )
 
     update_dissolving_messages(user, 'matchmaking', message)
-    games = get_games()
-    if not games:
-        logger.info(f'No games found.')
-        new_game(user, states.PVP_GAME)
-    else:
-        logger.info(f'User id {user.user_id} is looking for game.')
-        join_pvp_game(bot, user)
+    # a new game is created when there is no game to join
+    logger.info(f'User id {user.user_id} is looking for game.')
+    join_pvp_game(bot, user)
 
 
-def start_new_game(bot: telebot.TeleBot, usr: telebot.types.User, mode: str) -> None:
+def start_new_game(bot: telebot.TeleBot, usr: telebot.types.User, mode: str,
+                   level: str = config.AI_DEFAULT_LEVEL) -> None:
     """
     Starts a new game leading with usr
     :param bot: Bot object that manages all the stuff
     :param usr: telebot.types.User object of person, who creates a game
     :param mode: either 'ai' or 'person' string
+    :param level: key of config.AI_LEVELS for AI games
     :return: None. Terminates when user is already in game
     """
     user = get_user_or_none(usr)
@@ -225,25 +462,29 @@ def start_new_game(bot: telebot.TeleBot, usr: telebot.types.User, mode: str) ->
         return
 
     if mode == 'ai':
-        handle_ai_game(bot, user)
+        handle_ai_game(bot, user, level)
     elif mode == 'person':
         handle_pvp_game(bot, user)
 
 
-def new_game(user: User, game_type: int) -> None:
+def new_game(user: User, game_type: int) -> int:
     """
     Creates a new matchmaking game with user and givenn type
     :param user: User object to be a part of game
     :param game_type: either states.PVP_GAME or states.AI_GAME
+    :return: id of the game
     """
     logger.info(f'id {user.user_id} creates new game.')
 
-    Game.insert(
+    game_id = Game.insert(
         user1=user,
         type=game_type,
         state=states.MATCHMAKING_GAME,
-        field=json.dumps([[0 for _ in range(config.COLS)] for _ in range(config.ROWS)])
+        field=codec.empty_field()
     ).execute()
+    invalidate_games(user.id)
+
+    return game_id
 
 
 # not used now, will be helpful for inline mode
@@ -260,49 +501,116 @@ def new_game_from2(bot: telebot.TeleBot, user1: User, user2: User) -> None:
     game2 = get_users_game(user2)
 
     if game1:
-        Game.delete_by_id(game1.id)
+        delete_game(game1)
     if game2:
-        Game.delete_by_id(game2.id)
+        delete_game(game2)
 
     game = Game.create(
         user1=user1,
         user2=user2,
         type=states.PVP_GAME,
         state=states.RUNNING_GAME,
-        field=json.dumps([[0 for _ in range(config.COLS)] for _ in range(config.ROWS)])
+        field=codec.empty_field()
     )
+    invalidate_game(game)
 
     send_first_pvp_game_message(bot, game)
 
 
 def join_pvp_game(bot: telebot.TeleBot, user: User) -> None:
     """
-    Inserts user to an existing matchmaking game. In case game is already filled, creates  a new one
+    Inserts user to the longest waiting matchmaking game. In case there is none, queues a new one
     :param bot: Bot object that manages all the stuff
     :param user: User object to join pvp game
     :return: Terminates if creating new game scenario triggered
     """
-    game = Game.get_or_none(Game.state == states.MATCHMAKING_GAME)
+    queue = matchmaking.get_queue()
+    bucket = queue.bucket(user.wins - user.losses)
+
+    while True:
+        waiting = queue.join(
+            bucket,
+            lambda: new_game(user, states.PVP_GAME),
+            lambda expired: handle_matchmaking_timeout(bot, expired)
+        )
+        if not waiting:
+            logger.info('No matchmaking game found, created a new one.')
+            return
 
-    if not game:
-        logger.info('No matchmaking game found, creating a new one.')
-        new_game(user, states.PVP_GAME)
-        return
+        # the game may have been left after it was taken from the queue
+        joined = Game.update(
+            state=states.RUNNING_GAME,
+            user2=user
+        ).where(
+            (Game.id == waiting.game_id) & (Game.state == states.MATCHMAKING_GAME)
+        ).execute()
+        if joined:
+            break
+        logger.info(f'Game {waiting.game_id} was left before id {user.user_id} joined it.')
 
-    game.state = states.RUNNING_GAME
-    game.user2 = user
-    update_game(game)
+    game = get_game(waiting.game_id)
+    invalidate_game(game)
 
     send_first_pvp_game_message(bot, game)
 
 
-def new_ai_game(bot: telebot.TeleBot, user: User) -> None:
+def restore_matchmaking(bot: telebot.TeleBot) -> None:
+    """
+    Queues games left waiting for opponents by the previous run of the bot
+    :param bot: Bot object that manages all the stuff
+    """
+    queue = matchmaking.get_queue()
+    with connection():
+        games = list(Game
+                     .select(Game, User)
+                     .join(User, on=(Game.user1 == User.id))
+                     .where((Game.state == states.MATCHMAKING_GAME) & (Game.type == states.PVP_GAME))
+                     .order_by(Game.created))
+    for game in games:
+        queue.restore(matchmaking.Waiting(
+            game.id,
+            queue.bucket(game.user1.wins - game.user1.losses),
+            game.created,
+            lambda expired: handle_matchmaking_timeout(bot, expired)
+        ))
+    logger.info(f'Restored {len(queue)} matchmaking games.')
+
+
+def handle_matchmaking_timeout(bot: telebot.TeleBot, waiting: matchmaking.Waiting) -> None:
+    """
+    Cancels the search of a player nobody joined in time
+    :param bot: Bot object that manages all the stuff
+    :param waiting: timed out game taken from the matchmaking queue
+    """
+    # runs in the sweeper thread of the queue, not in a handler one holding a connection
+    with connection():
+        game = get_game(waiting.game_id)
+        if not game or game.state != states.MATCHMAKING_GAME:
+            return
+
+        user = game.user1
+        logger.info(f'Nobody joined game {game.id} of id {user.user_id} in time.')
+        with atomic():
+            delete_game(game)
+            user.state = states.USER_IN_MENU
+            update_user(user)
+
+        bot.send_message(
+            user.user_id,
+            'Nobody has joined the game, try again later with /game.'
+        )
+        delete_dissolving_messages(bot, [user], ['matchmaking'])
+
+
+def new_ai_game(bot: telebot.TeleBot, user: User, level: str) -> None:
     game = Game.create(
         user1=user,
         type=states.AI_GAME,
         state=states.RUNNING_GAME,
-        field=json.dumps([[0 for _ in range(config.COLS)] for _ in range(config.ROWS)])
+        field=codec.empty_field(),
+        difficulty=level
     )
+    invalidate_game(game)
 
     send_first_ai_game_message(bot, game)
 
@@ -316,7 +624,7 @@ def send_first_ai_game_message(bot: telebot.TeleBot, game: Game) -> None:
         f'Your signature is `{config.SIGNATURES[1]}`.',
         parse_mode='Markdown',
         reply_markup=buttons.get_field_markup(
-            json.loads(game.field)
+            codec.decode_field(game.field)
         )
     )
     game.message1 = message.message_id
@@ -328,7 +636,7 @@ def send_first_ai_game_message(bot: telebot.TeleBot, game: Game) -> None:
     )
     update_dissolving_messages(user, 'first_message', message)
 
-    delete_dissolving_messages(bot, user, ['starting_the_game', 'matchmaking'])
+    delete_dissolving_messages(bot, [user], ['starting_the_game', 'matchmaking'])
 
 
 def send_first_pvp_game_message(bot: telebot.TeleBot, game: Game) -> None:
@@ -338,8 +646,11 @@ def send_first_pvp_game_message(bot: telebot.TeleBot, game: Game) -> None:
     :param game: Game to begin and send first messages and a board to its players
     """
     logger.info(f'Sending first PVP game message for {game.user1.user_id} and {game.user2.user_id}')
-    for user in [game.user1, game.user2]:
-        message = bot.send_message(
+    users = [game.user1, game.user2]
+    calls = []
+    for user in users:
+        calls.append(partial(
+            bot.send_message,
             user.user_id,
             'Game is starting! Your opponent is [{first_name}](tg://user?id={id}). '.format(
                 first_name=game.user2.first_name if user == game.user1 else game.user1.first_name,
@@ -347,29 +658,23 @@ def send_first_pvp_game_message(bot: telebot.TeleBot, game: Game) -> None:
             ) + 'Your signature is `{}`.'.format(config.SIGNATURES[1 if user == game.user1 else 2]),
             parse_mode='Markdown',
             reply_markup=buttons.get_field_markup(
-                json.loads(game.field)
+                codec.decode_field(game.field)
             )
-        )
-        if user == game.user1:
-            game.message1 = message.message_id
-        else:
-            game.message2 = message.message_id
-        update_game(game)
+        ))
+        calls.append(partial(
+            bot.send_message,
+            user.user_id,
+            'You are starting.' if user == game.user1 else 'Wait until opponent makes first turn.'
+        ))
+    board1, first_message1, board2, first_message2 = concurrently(*calls)
 
-        if user == game.user1:
-            message = bot.send_message(
-                user.user_id,
-                'You are starting.'
-            )
-            update_dissolving_messages(user, 'first_message', message)
-        else:
-            message = bot.send_message(
-                user.user_id,
-                'Wait until opponent makes first turn.'
-            )
-            update_dissolving_messages(user, 'first_message', message)
+    game.message1 = board1.message_id
+    game.message2 = board2.message_id
+    update_game(game)
 
-        delete_dissolving_messages(bot, user, ['starting_the_game', 'matchmaking'])
+    update_dissolving_messages(game.user1, 'first_message', first_message1)
+    update_dissolving_messages(game.user2, 'first_message', first_message2)
+    delete_dissolving_messages(bot, users, ['starting_the_game', 'matchmaking'])
 
 
 def update_dissolving_messages(user: User, key: str, message: telebot.types.Message) -> None:
@@ -424,22 +729,25 @@ def filter_dissolving_messages(user: User, keys: List[str]) -> None:
     update_user(user)
 
 
-def delete_dissolving_messages(bot: telebot.TeleBot, user: User, keys: List[str]) -> None:
+def delete_dissolving_messages(bot: telebot.TeleBot, users: Sequence[User], keys: List[str]) -> None:
     """
-    Deletes sent messages for user that are marked with given keys on DB
+    Deletes sent messages for users that are marked with given keys on DB
     :param bot: Bot object that manages all the stuff
-    :param user: User object to whose chat messages will be altered
+    :param users: User objects to whose chats messages will be altered
     :param keys: list of dict keys (labels of messages)
     """
-    logger.info(f'Deleting messages with keys `{keys}` from id {user.user_id}.')
-    to_delete = get_dissolving_messages(user, keys)
-    for message in to_delete:
-        bot.delete_message(
-            message.chat.id,
-            message.message_id
-        )
+    calls = []
+    for user in users:
+        logger.info(f'Deleting messages with keys `{keys}` from id {user.user_id}.')
+        chats: Dict[int, List[int]] = {}
+        for message in get_dissolving_messages(user, keys):
+            chats.setdefault(message.chat.id, []).append(message.message_id)
+        # one call for all messages of a chat, messages that are gone already are skipped
+        calls.extend(partial(bot.delete_messages, chat_id, message_ids) for chat_id, message_ids in chats.items())
+    concurrently(*calls)
 
-    filter_dissolving_messages(user, keys)
+    for user in users:
+        filter_dissolving_messages(user, keys)
 
 
 def has_winner(field: List[List[int]]) -> Tuple[bool, Optional[Tuple[int, int]], Optional[Tuple[int, int]]]:
@@ -457,15 +765,14 @@ def has_winner(field: List[List[int]]) -> Tuple[bool, Optional[Tuple[int, int]],
             if field[i][j] == 0:
                 continue
             for dr in dirs:
-                # simply checking an equality of 4 contiguous elements on field
-                try:
-                    if field[i][j] == field[i + dr[0]][j + dr[1]] == \
-                            field[i + 2 * dr[0]][j + 2 * dr[1]] == \
-                            field[i + 3 * dr[0]][j + 3 * dr[1]] :
-                        return True, (i, j), dr
-                # to skip border cases without making some stupidly clever algorithm
-                except IndexError:
+                # the line has to end on the field, negative indices would wrap around to the other side
+                if not (0 <= i + 3 * dr[0] < len(field) and 0 <= j + 3 * dr[1] < len(field[i])):
                     continue
+                # simply checking an equality of 4 contiguous elements on field
+                if field[i][j] == field[i + dr[0]][j + dr[1]] == \
+                        field[i + 2 * dr[0]][j + 2 * dr[1]] == \
+                        field[i + 3 * dr[0]][j + 3 * dr[1]]:
+                    return True, (i, j), dr
 
     # checking if any empty cells left after checking winning positions as
     # last move can cause it as well
@@ -480,6 +787,58 @@ def has_winner(field: List[List[int]]) -> Tuple[bool, Optional[Tuple[int, int]],
     return False, None, None
 
 
+def count_line(field: List[List[int]], row: int, col: int, dr: Tuple[int, int], sig: int) -> int:
+    """
+    :param field: playing field matrix
+    :param row: row of the cell to start from
+    :param col: column of the cell to start from
+    :param dr: (delta_row, delta_col) to go by
+    :param sig: signature to count
+    :return: number of sig cells in a row next to the starting one in dr direction, at most 3
+    """
+    count = 0
+    row, col = row + dr[0], col + dr[1]
+    while count < 3 and 0 <= row < len(field) and 0 <= col < len(field[row]) and field[row][col] == sig:
+        count += 1
+        row, col = row + dr[0], col + dr[1]
+    return count
+
+
+def check_move(field: List[List[int]], row: int, col: int,
+               moves: int) -> Tuple[bool, Optional[Tuple[int, int]], Optional[Tuple[int, int]]]:
+    """
+    Same as has_winner for a field that had no winner before the stone at (row, col) was dropped:
+    only lines through that cell are checked and the field is full when every move is made
+    :param field: playing field matrix with the stone dropped
+    :param row: row of the dropped stone
+    :param col: column of the dropped stone
+    :param moves: number of stones on field including the dropped one
+    :return: Same as has_winner
+    """
+    # directions in the order has_winner checks them
+    dirs = [(0, 1), (1, 0), (1, 1), (1, -1)]
+    sig = field[row][col]
+
+    best = None
+    for index, dr in enumerate(dirs):
+        back = count_line(field, row, col, (-dr[0], -dr[1]), sig)
+        if back + 1 + count_line(field, row, col, dr, sig) < 4:
+            continue
+        # has_winner finds the line starting furthest back first, and the first direction among lines
+        # starting at the same cell
+        start = (row - back * dr[0], col - back * dr[1])
+        if best is None or (start, index) < best:
+            best = (start, index)
+
+    if best:
+        return True, best[0], dirs[best[1]]
+
+    if moves == config.ROWS * config.COLS:
+        return True, (0, 0), (0, 0)
+
+    return False, None, None
+
+
 def flatten(lst: List[List[Any]]) -> List[Any]:
     """
     :param lst: list of lists to be flattened
@@ -509,7 +868,16 @@ def handle_game_field_click(bot: telebot.TeleBot, cb: telebot.types.CallbackQuer
 def handle_ai_game_click(bot, cb, y):
 
     game, user, _ = get_game_user_opponent(cb.from_user)
-    field = json.loads(game.field)
+    if not game:
+        return
+    if game.move != 1:
+        bot.answer_callback_query(
+            cb.id,
+            'Wait until AI makes its move.',
+            show_alert=True
+        )
+        return
+    field = codec.decode_field(game.field)
     if field[0][y] != 0:
         bot.answer_callback_query(
             cb.id,
@@ -524,38 +892,151 @@ def handle_ai_game_click(bot, cb, y):
 
     field[k][y] = 1
 
-    winner, win_coords, win_dir = has_winner(field)
+    # saved and shown before the AI starts thinking, as it may finish before this handler does;
+    # clicks are refused until the AI move is made
+    previous_field = game.field
+    game.field = codec.encode_field(field)
+    game.move = 2
+    game.moves += 1
+    if not update_game(game, (1, game.moves - 1)):
+        # another click of this turn has moved already
+        bot.answer_callback_query(
+            cb.id,
+            'Wait until AI makes its move.',
+            show_alert=True
+        )
+        return
+
+    winner, win_coords, win_dir = check_move(field, k, y, game.moves)
     if winner:
-        logger.info(f'Game {game} ended with winner {user.user_id}')
-        handle_win(bot, field, game, user, _, win_coords, win_dir, 1)
+        if win_dir == (0, 0):
+            logger.info(f'Game {game} ended with draw.')
+            handle_draw(bot, game, user, None)
+        else:
+            logger.info(f'Game {game} ended with winner {user.user_id}')
+            handle_win(bot, field, game, user, _, win_coords, win_dir, 1)
+        return
+
+    send_updated_field(bot, field, game, _)
+
+    # the move is taken back when AI can't take it, otherwise the game waits for an AI move that never comes
+    if not request_ai_move(bot, game):
+        game.field = previous_field
+        game.move = 1
+        game.moves -= 1
+        update_game(game)
+        send_updated_field(bot, codec.decode_field(previous_field), game, _)
+        bot.answer_callback_query(
+            cb.id,
+            'AI is busy with other games right now. Try again in a moment.',
+            show_alert=True
+        )
         return
-    else:
-        send_updated_field(bot, field, game, _)
 
     bot.answer_callback_query(
         cb.id,
         "OK."
     )
 
-    col = ai.minimax_alpha_beta(field, config.AI_DEPTH, 2)
+
+def request_ai_move(bot: telebot.TeleBot, game: Game) -> bool:
+    """
+    Queues computation of AI move for game waiting for it
+    :param bot: Bot object that manages all the stuff
+    :param game: AI game with move 2
+    :return: False if AI service refused or failed to queue the move
+    """
+    try:
+        return ai_service.get_service().submit(
+            game.field, 2, game.difficulty, game.id,
+            lambda future: handle_ai_move(bot, game.id, future)
+        )
+    except Exception:
+        logger.exception(f'Queuing AI move for game {game.id} failed.')
+        return False
+
+
+def restore_ai_moves(bot: telebot.TeleBot) -> None:
+    """
+    Queues AI moves the previous run of the bot has not made, games waiting for them refuse every click
+    :param bot: Bot object that manages all the stuff
+    """
+    with connection():
+        games = list(Game
+                     .select(Game, User)
+                     .join(User, on=(Game.user1 == User.id))
+                     .where((Game.state == states.RUNNING_GAME) & (Game.type == states.AI_GAME) & (Game.move == 2)))
+    for game in games:
+        if not request_ai_move(bot, game):
+            # the human move can't be taken back, as the field before it is not kept
+            handle_ai_move(bot, game.id, None)
+    logger.info(f'Restored {len(games)} AI moves.')
+
+
+def handle_ai_move(bot: telebot.TeleBot, game_id: int, future: Optional[Future],
+                   retries: int = config.AI_MOVE_RETRIES) -> None:
+    """
+    Makes the move computed by AI service and refreshes the field
+    :param bot: Bot object that manages all the stuff
+    :param game_id: id of game the move was computed for
+    :param future: finished AI service future holding the column, None to fall back to depth 1
+    :param retries: times a failed move is made again with the fallback one
+    :return: Terminates when the game was left while AI was thinking
+    """
+    # runs in a callback thread of AI service, not in a handler one holding a connection
+    try:
+        with connection():
+            _handle_ai_move(bot, game_id, future)
+    except Exception:
+        # a move already made is not made twice, as the game is not waiting for AI then
+        if not retries:
+            logger.exception(f'Making AI move for game {game_id} failed, it is made after the bot restarts.')
+            return
+        logger.exception(f'Making AI move for game {game_id} failed, '
+                         f'falling back to depth 1 in {config.AI_MOVE_RETRY_DELAY}s.')
+        timer = threading.Timer(config.AI_MOVE_RETRY_DELAY, handle_ai_move, (bot, game_id, None, retries - 1))
+        timer.daemon = True
+        timer.start()
+
+
+def _handle_ai_move(bot: telebot.TeleBot, game_id: int, future: Optional[Future]) -> None:
+    game = get_game(game_id)
+    if not game or game.move != 2:
+        logger.info(f'Game {game_id} is not waiting for AI move anymore.')
+        return
+
+    user = game.user1
+    field = codec.decode_field(game.field)
+    try:
+        col = future.result() if future else None
+    except Exception:
+        logger.exception(f'AI failed to compute move for game {game_id}, falling back to depth 1.')
+        col = None
+    if col is None:
+        col = ai.minimax_alpha_beta(field, 1, 2)
+
     k = config.ROWS - 1
     while field[k][col] != 0:
         k -= 1
     field[k][col] = 2
 
-    game.field = json.dumps(field)
-    update_game(game)
+    game.field = codec.encode_field(field)
+    game.move = 1
+    game.moves += 1
+    if not update_game(game, (2, game.moves - 1)):
+        logger.info(f'Game {game_id} was left while AI was moving.')
+        return
 
-    winner, win_coords, win_dir = has_winner(field)
+    winner, win_coords, win_dir = check_move(field, k, col, game.moves)
     if winner:
         if win_dir == (0, 0):
             logger.info(f'Game {game} ended with draw.')
-            handle_draw(bot, game, user, _)
+            handle_draw(bot, game, user, None)
         else:
             logger.info(f'Game {game} ended with winner AI')
-            handle_win(bot, field, game, user, _, win_coords, win_dir, 2)
+            handle_win(bot, field, game, user, None, win_coords, win_dir, 2)
     else:
-        send_updated_field(bot, field, game, _)
+        send_updated_field(bot, field, game, None)
 
 
 def handle_pvp_game_click(bot, cb, y):
@@ -571,12 +1052,11 @@ def handle_pvp_game_click(bot, cb, y):
         )
         return
     if [game.user1, game.user2][game.move - 1].user_id == cb.from_user.id:
-        field = json.loads(game.field)
+        field = codec.decode_field(game.field)
 
-        # to perform with first move only
-        if sum(flatten(field)) < 2:
-            delete_dissolving_messages(bot, user, ['first_message'])
-            delete_dissolving_messages(bot, opponent, ['first_message'])
+        # to perform with first move of each player only
+        if game.moves < 2:
+            delete_dissolving_messages(bot, [user, opponent], ['first_message'])
 
         if field[0][y] != 0:
             bot.answer_callback_query(
@@ -592,16 +1072,25 @@ def handle_pvp_game_click(bot, cb, y):
 
         field[k][y] = game.move
 
-        game.field = json.dumps(field)
+        turn = (game.move, game.moves)
+        game.field = codec.encode_field(field)
         game.move = 1 if game.move == 2 else 2
-        update_game(game)
+        game.moves += 1
+        if not update_game(game, turn):
+            # another click of this turn has moved already
+            bot.answer_callback_query(
+                cb.id,
+                "It's not your turn.",
+                show_alert=True,
+            )
+            return
 
         bot.answer_callback_query(
             cb.id,
             "OK."
         )
 
-        winner, win_coords, win_dir = has_winner(field)
+        winner, win_coords, win_dir = check_move(field, k, y, game.moves)
         if winner:
             if win_dir == (0, 0):
                 logger.info(f'Game {game} ended with draw.')
@@ -630,27 +1119,21 @@ def handle_draw(bot: telebot.TeleBot, game: Game, user: User, opponent: User) ->
     """
     field = [[3 for _ in range(config.COLS)] for _ in range(config.ROWS)]
 
-    send_updated_field(bot, field, game, opponent)
-    Game.delete_by_id(game.id)
-
-    if opponent:
-        for u in [user, opponent]:
-            bot.send_message(
-                u.user_id,
-                "It's a draw."
-            )
-        user.draws += 1
-        opponent.draws += 1
-        opponent.state = states.USER_IN_MENU
-        update_user(opponent)
-    else:
-        bot.send_message(
-            user.user_id,
-            "It's a draw."
-        )
-
-    user.state = states.USER_IN_MENU
-    update_user(user)
+    with atomic():
+        delete_game(game)
+        if opponent:
+            user.draws += 1
+            opponent.draws += 1
+            opponent.state = states.USER_IN_MENU
+            update_user(opponent)
+        user.state = states.USER_IN_MENU
+        update_user(user)
+
+    # the bombed field is shown before the draw message of its chat
+    concurrently(
+        *field_updates(bot, field, game, opponent),
+        *[partial(bot.send_message, u.user_id, "It's a draw.") for u in ([user, opponent] if opponent else [user])]
+    )
 
 
 def handle_win(bot: telebot.TeleBot, field: List[List[int]], game: Game, user: User, opponent: User,
@@ -668,32 +1151,28 @@ def handle_win(bot: telebot.TeleBot, field: List[List[int]], game: Game, user: U
     """
     for i in range(4):
         field[win_coords[0] + win_dir[0] * i][win_coords[1] + win_dir[1] * i] = 3
-    Game.delete_by_id(game.id)
 
-    if opponent:
-        user.wins += 1
-        opponent.losses += 1
-        opponent.state = states.USER_IN_MENU
-        update_user(opponent)
-    user.state = states.USER_IN_MENU
-    update_user(user)
+    with atomic():
+        delete_game(game)
+        if opponent:
+            user.wins += 1
+            opponent.losses += 1
+            opponent.state = states.USER_IN_MENU
+            update_user(opponent)
+        user.state = states.USER_IN_MENU
+        update_user(user)
 
     if opponent:
-        bot.send_message(
-            user.user_id,
-            "Congratulations! You won."
-        )
-        bot.send_message(
-            opponent.user_id,
-            "Oh. You lost."
-        )
+        messages = [
+            partial(bot.send_message, user.user_id, "Congratulations! You won."),
+            partial(bot.send_message, opponent.user_id, "Oh. You lost.")
+        ]
     else:
-        bot.send_message(
-            user.user_id,
-            "Congratulations! You won." if player == 1 else "Oh. You lost."
-        )
+        messages = [
+            partial(bot.send_message, user.user_id, "Congratulations! You won." if player == 1 else "Oh. You lost.")
+        ]
 
-    send_updated_field(bot, field, game, opponent)
+    concurrently(*messages, *field_updates(bot, field, game, opponent))
 
 
 def send_updated_field(bot: telebot.TeleBot, field: List[List[int]], game: Game, opponent: User) -> None:
@@ -704,21 +1183,29 @@ def send_updated_field(bot: telebot.TeleBot, field: List[List[int]], game: Game,
     :param game: Game object, where update is needed
     :param opponent: Symbolizes a player, whose turn is next
     """
+    concurrently(*field_updates(bot, field, game, opponent))
+
+
+def field_updates(bot: telebot.TeleBot, field: List[List[int]], game: Game, opponent: User) -> List[partial]:
+    """
+    :return: calls refreshing the game messages, see send_updated_field
+    """
+    markup = buttons.get_field_markup(field)
     if opponent:
-        for i in range(2):
-            bot.edit_message_text(
+        # the hint and the field are changed by one edit
+        return [
+            partial(
+                bot.edit_message_text,
                 chat_id=[game.user1, game.user2][i].user_id,
                 message_id=[game.message1, game.message2][i],
-                text='Your turn' if [game.user1, game.user2][i] == opponent else 'Opponents turn.'
+                text='Your turn' if [game.user1, game.user2][i] == opponent else 'Opponents turn.',
+                reply_markup=markup
             )
-            bot.edit_message_reply_markup(
-                [game.user1, game.user2][i].user_id,
-                [game.message1, game.message2][i],
-                reply_markup=buttons.get_field_markup(field)
-            )
-    else:
-        bot.edit_message_reply_markup(
-            game.user1.user_id,
-            game.message1,
-            reply_markup=buttons.get_field_markup(field)
-        )
+            for i in range(2)
+        ]
+    return [partial(
+        bot.edit_message_reply_markup,
+        game.user1.user_id,
+        game.message1,
+        reply_markup=markup
+    )]
@@ -0,0 +1,135 @@
+"""
+Webhook mode of the bot: Telegram posts updates to a small HTTP server, which checks the secret token
+and hands them to the sharded dispatcher running the handlers of bot.py.
+"""
+import hmac
+import secrets
+import ssl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Tuple
+from urllib.parse import urlparse
+
+import telebot
+
+import config
+import logger
+from dispatcher import ShardedDispatcher
+
+# introducing a logger
+logger = logger.get_logger(__name__)
+
+# updates are small, anything bigger than this is not from Telegram
+MAX_UPDATE_SIZE = 1 << 20
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    Accepts POSTs of updates to the webhook path
+    """
+    # keeps connections Telegram opens for following updates
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    server: 'WebhookServer'
+
+    def do_POST(self):
+        if self.path != self.server.path:
+            self.send_error(404)
+            return
+
+        token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token.encode(), self.server.secret_token.encode()):
+            logger.warning(f'Refusing update from {self.client_address[0]} with a wrong secret token.')
+            self.send_error(403)
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        if length > MAX_UPDATE_SIZE:
+            self.send_error(413)
+            return
+
+        try:
+            update = telebot.types.Update.de_json(self.rfile.read(length).decode('utf-8'))
+        except (ValueError, KeyError):
+            self.send_error(400)
+            return
+
+        if not self.server.dispatcher.submit(update):
+            # Telegram delivers the update again later
+            self.send_response(503)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(f'{self.client_address[0]} {format % args}')
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    HTTP server feeding posted updates to the handlers of bot through dispatcher. Updates are refused
+    while the queue of their shard is full, until it catches up.
+    """
+    daemon_threads = True
+
+    def __init__(self, dispatcher: ShardedDispatcher, address: Tuple[str, int], path: str, secret_token: str,
+                 ssl_context: Optional[ssl.SSLContext] = None):
+        super().__init__(address, WebhookHandler)
+        if ssl_context:
+            # handshakes are made in connection threads, not in the one accepting connections
+            self.socket = ssl_context.wrap_socket(self.socket, server_side=True, do_handshake_on_connect=False)
+
+        self.dispatcher = dispatcher
+        self.path = path
+        self.secret_token = secret_token
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.dispatcher.stop()
+
+
+def run(bot: telebot.TeleBot, dispatcher: ShardedDispatcher) -> None:
+    """
+    Registers the webhook of config.WEBHOOK_URL with Telegram and serves it until interrupted
+    :param bot: Bot object that manages all the stuff
+    :param dispatcher: dispatcher of the handlers of bot
+    """
+    # Telegram sends it with every update, a new one for every run when it's not configured
+    secret_token = config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+
+    ssl_context = None
+    if config.WEBHOOK_CERT and config.WEBHOOK_KEY:
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.load_cert_chain(config.WEBHOOK_CERT, config.WEBHOOK_KEY)
+
+    server = WebhookServer(
+        dispatcher,
+        (config.WEBHOOK_HOST, config.WEBHOOK_PORT),
+        urlparse(config.WEBHOOK_URL).path or '/',
+        secret_token,
+        ssl_context=ssl_context
+    )
+
+    # a self-signed certificate has to be uploaded, one of a trusted CA or a proxy's is not
+    certificate = open(config.WEBHOOK_CERT, 'rb') if ssl_context and config.WEBHOOK_SELF_SIGNED else None
+    try:
+        bot.set_webhook(
+            url=config.WEBHOOK_URL,
+            certificate=certificate,
+            max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=['message', 'callback_query'],
+            secret_token=secret_token
+        )
+    finally:
+        if certificate:
+            certificate.close()
+
+    logger.info(f'Serving webhook {config.WEBHOOK_URL} on {config.WEBHOOK_HOST}:{config.WEBHOOK_PORT}.')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()